@@ -2,26 +2,70 @@ import os
 import torch
 import shutil
 import cv2
+import cProfile
+import hashlib
+import json
 import mimetypes
+import multiprocessing
+import queue
+import re
+import signal
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
+from werkzeug.security import safe_join
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from torchvision.ops import batched_nms
 import random
-from sqlalchemy import func, text
+from sqlalchemy import func, text, update, delete, insert, select, exists, or_, inspect
 from sklearn.model_selection import train_test_split
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 load_dotenv()
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL') or f"mysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# пакетная загрузка разметки: изображения и .txt одной формой
+app.config['MAX_FORM_PARTS'] = int(os.getenv('MAX_FORM_PARTS', 50000))
 
 app.secret_key = os.getenv('SECRET_KEY')
 
+# пул соединений: под несколькими процессами каждый держит свой пул, MySQL закрывает простаивающие соединения
+engine_options = {
+    'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 280)),
+}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    engine_options.update(
+        pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    )
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
 db = SQLAlchemy(app)
 
 class Photo(db.Model):
+    __table_args__ = (
+        db.Index('ix_photo_modul_id', 'modul', 'id'),
+        db.Index('ix_photo_modul_txt', 'modul', 'txt'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     photo = db.Column(db.String(255), nullable=False) 
     processed_photo = db.Column(db.String(255), nullable=True)
@@ -29,65 +73,876 @@ class Photo(db.Model):
     is_discovered = db.Column(db.Boolean, nullable=False, default=0) 
     photo_date = db.Column(db.DateTime, nullable=False)
     modul = db.Column(db.Boolean, nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey('inference_job.id'), nullable=True, index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=True, index=True)
+    frame_time = db.Column(db.Float, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+
+class Video(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    video = db.Column(db.String(255), nullable=False)
+    video_date = db.Column(db.DateTime, nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey('inference_job.id'), nullable=True, index=True)
+    frame_count = db.Column(db.Integer, nullable=True)
+    skipped_frames = db.Column(db.Integer, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+
+class InferenceJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    model_id = db.Column(db.Integer, nullable=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    discovered = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
 class Dataset(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     dataset = db.Column(db.String(255), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('dataset.id'), nullable=True)
 
 class Model(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     model = db.Column(db.String(255), nullable=False)
+    backend = db.Column(db.String(20), nullable=True)
 
-with app.app_context():
-    db.create_all()
+class ModelExport(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False, index=True)
+    backend = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    path = db.Column(db.String(255), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class Detection(db.Model):
+    __table_args__ = (db.Index('ix_detection_class_confidence', 'class_name', 'confidence'),)
 
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id', ondelete='CASCADE'), nullable=False, index=True)
+    model_id = db.Column(db.Integer, nullable=False, default=0)
+    class_id = db.Column(db.Integer, nullable=False)
+    class_name = db.Column(db.String(64), nullable=False)
+    confidence = db.Column(db.Float, nullable=False)
+    x1 = db.Column(db.Float, nullable=False)
+    y1 = db.Column(db.Float, nullable=False)
+    x2 = db.Column(db.Float, nullable=False)
+    y2 = db.Column(db.Float, nullable=False)
+
+class DetectionCache(db.Model):
+    __table_args__ = (db.UniqueConstraint('image_hash', 'model_id', name='uq_detection_cache_image_model'),)
 
-def get_video_filename(video_path):
-    return os.path.basename(video_path)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    image_hash = db.Column(db.String(64), nullable=False)
+    model_id = db.Column(db.Integer, nullable=False)
+    model_mtime = db.Column(db.Float, nullable=False)
+    processed_photo = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
-def extract_frames(video_path, output_folder, frame_rate=10, db_session=None):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+class TrainingJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    dataset = db.Column(db.String(255), nullable=False)
+    model_name = db.Column(db.String(255), nullable=False)
+    imgsz = db.Column(db.Integer, nullable=False)
+    epochs = db.Column(db.Integer, nullable=False)
+    batch = db.Column(db.Integer, nullable=False)
+    save_period = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    resume = db.Column(db.Boolean, nullable=False, default=False)
+    epoch = db.Column(db.Integer, nullable=False, default=0)
+    metrics = db.Column(db.Text, nullable=True)
+    eta_seconds = db.Column(db.Float, nullable=True)
+    run_dir = db.Column(db.String(255), nullable=True)
+    pid = db.Column(db.Integer, nullable=True)
+    model_id = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    total_chunks = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)
+    model_id = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='uploading', index=True)
+    job_id = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+class UploadChunk(db.Model):
+    __table_args__ = (db.UniqueConstraint('upload_id', 'chunk_index', name='uq_upload_chunk'),)
 
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload.id', ondelete='CASCADE'), nullable=False, index=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    checksum = db.Column(db.String(64), nullable=False)
+
+class CachedCounter(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class DamageFilter(db.Model):
+    # активный фильтр повреждений модели, 0 - модель по умолчанию
+    model_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    class_name = db.Column(db.String(64), nullable=False)
+    min_confidence = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), "static", "best.pt")
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', 2))
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 1))
+INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', 32))
+# disk - прежний проход через папку на диске (своя для каждого вызова), memory - пакетный инференс без копий
+INFERENCE_MODE = os.getenv('INFERENCE_MODE', 'disk')
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'pytorch')
+MODEL_BACKENDS = {
+    'pytorch': None,
+    'onnx': {'format': 'onnx'},
+    'openvino': {'format': 'openvino'},
+    'openvino_int8': {'format': 'openvino', 'int8': True},
+}
+EXPORT_INT8_FRACTION = float(os.getenv('EXPORT_INT8_FRACTION', 0.1))
+DAMAGE_CLASS = os.getenv('DAMAGE_CLASS', 'BadTree')
+DAMAGE_MIN_CONFIDENCE = float(os.getenv('DAMAGE_MIN_CONFIDENCE', 0))
+# нарезка крупных снимков на перекрывающиеся тайлы, чтобы не терять мелкие объекты при уменьшении до imgsz
+TILED_INFERENCE = os.getenv('TILED_INFERENCE', '0') == '1'
+TILE_SIZE = int(os.getenv('TILE_SIZE', 640))
+TILE_OVERLAP = float(os.getenv('TILE_OVERLAP', 0.2))
+TILE_BATCH_SIZE = int(os.getenv('TILE_BATCH_SIZE', 16))
+TILE_NMS_IOU = float(os.getenv('TILE_NMS_IOU', 0.5))
+TILE_INCLUDE_FULL_FRAME = os.getenv('TILE_INCLUDE_FULL_FRAME', '1') == '1'
+VIDEO_ENCODE_WORKERS = int(os.getenv('VIDEO_ENCODE_WORKERS', 4))
+# при большом шаге между кадрами перемотка дешевле, чем grab() каждого пропускаемого кадра
+VIDEO_SEEK_THRESHOLD = int(os.getenv('VIDEO_SEEK_THRESHOLD', 250))
+GALLERY_PAGE_SIZE = int(os.getenv('GALLERY_PAGE_SIZE', 60))
+TRAIN_MAX_CONCURRENT = int(os.getenv('TRAIN_MAX_CONCURRENT', 1))
+TRAIN_POLL_INTERVAL = float(os.getenv('TRAIN_POLL_INTERVAL', 5))
+RESUMABLE_CHUNK_SIZE = int(os.getenv('RESUMABLE_CHUNK_SIZE', 8 * 1024 * 1024))
+RESUMABLE_MAX_CHUNK_SIZE = int(os.getenv('RESUMABLE_MAX_CHUNK_SIZE', 64 * 1024 * 1024))
+MODEL_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+MODEL_UPLOAD_QUERY_BATCH = int(os.getenv('MODEL_UPLOAD_QUERY_BATCH', 5000))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 8))
+THUMBNAIL_SIZES = {'small': 320, 'medium': 800, 'large': 1600}
+THUMBNAIL_PREWARM_SIZES = os.getenv('THUMBNAIL_PREWARM_SIZES', 'small').split(',')
+THUMBNAIL_CACHE_DIR = os.getenv('THUMBNAIL_CACHE_DIR', os.path.join(os.path.dirname(__file__), "cache", "thumbnails"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv('THUMBNAIL_CACHE_MAX_MB', 1024)) * 1024 * 1024
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+# адрес миниатюры - путь к исходнику, который перезаписывается на месте: браузер перепроверяет её по ETag
+THUMBNAIL_MAX_AGE = int(os.getenv('THUMBNAIL_MAX_AGE', 300))
+VIDEO_FRAME_RATE = float(os.getenv('VIDEO_FRAME_RATE', 10))
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', os.path.join(os.path.dirname(__file__), "runs", "scratch"))
+LOCK_DIR = os.getenv('LOCK_DIR', os.path.join(os.path.dirname(__file__), "runs", "locks"))
+# задание в статусе running без обновлений дольше этого срока считается брошенным упавшим процессом
+INFERENCE_JOB_LEASE = int(os.getenv('INFERENCE_JOB_LEASE', 1800))
+# как часто долгая нарезка видео продлевает аренду задания, в секундах
+INFERENCE_LEASE_REFRESH = float(os.getenv('INFERENCE_LEASE_REFRESH', 60))
+# максимальное расстояние Хэмминга между dHash соседних кадров, при котором кадр считается дубликатом
+VIDEO_DEDUP_DISTANCE = int(os.getenv('VIDEO_DEDUP_DISTANCE', 5))
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 2))
+# профилирование включается явно и срабатывает только для запроса с ?profile=1 или X-Profile: 1
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '0') == '1'
+PROFILER = os.getenv('PROFILER', 'cprofile')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(__file__), "cache", "profiles"))
+# X-Request-ID приходит от клиента и попадает в имя файла профиля и в логи
+TRACE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+histograms = {}
+metrics_lock = threading.Lock()
+profile_lock = threading.Lock()
+trace_context = threading.local()
+
+def observe(metric, seconds, **labels):
+    key = (metric, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': [0] * len(METRIC_BUCKETS), 'count': 0, 'sum': 0.0}
+        for position, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][position] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+def record_span(stage, seconds):
+    observe('pinesnap_stage_seconds', seconds, stage=stage)
+    spans = getattr(trace_context, 'spans', None)
+    if spans is not None:
+        spans[stage] = spans.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+def record_result_speed(results):
+    # ultralytics сам меряет preprocess/inference/postprocess в мс на изображение
+    for result in results:
+        for stage, milliseconds in (result.speed or {}).items():
+            if milliseconds is not None:
+                record_span(stage, milliseconds / 1000)
+
+def current_trace_id():
+    return getattr(trace_context, 'trace_id', None)
+
+def begin_trace(trace_id):
+    trace_context.trace_id = trace_id
+    trace_context.spans = {}
+    trace_context.started = time.perf_counter()
+
+def end_trace():
+    spans = getattr(trace_context, 'spans', None) or {}
+    elapsed = time.perf_counter() - getattr(trace_context, 'started', time.perf_counter())
+    trace_context.trace_id = None
+    trace_context.spans = None
+    return elapsed, spans
+
+def format_spans(spans):
+    return ', '.join(f"{stage}={seconds * 1000:.1f}мс" for stage, seconds in sorted(spans.items(), key=lambda item: -item[1]))
+
+def start_profiler():
+    if not profile_lock.acquire(blocking=False):
+        print("Профилировщик уже занят другим запросом")
+        return None
+    if PROFILER == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument не установлен, используется cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profiler(profiler, trace_id):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            path = os.path.join(PROFILE_DIR, f"{trace_id}.prof")
+            profiler.dump_stats(path)
+        else:
+            profiler.stop()
+            path = os.path.join(PROFILE_DIR, f"{trace_id}.html")
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        print(f"[{trace_id}] Профиль запроса сохранён: {path}")
+        return path
+    finally:
+        profile_lock.release()
+
+@app.before_request
+def start_request_trace():
+    trace_id = request.headers.get('X-Request-ID', '')
+    begin_trace(trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else uuid.uuid4().hex)
+    trace_context.profiler = None
+    if PROFILE_REQUESTS and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        trace_context.profiler = start_profiler()
+
+@app.after_request
+def finish_request_trace(response):
+    trace_id = current_trace_id()
+    if trace_id is None:
+        return response
+
+    profiler = getattr(trace_context, 'profiler', None)
+    trace_context.profiler = None
+    elapsed, spans = end_trace()
+    observe('pinesnap_request_seconds', elapsed, endpoint=request.endpoint or 'unknown', method=request.method, status=str(response.status_code))
+
+    response.headers['X-Request-ID'] = trace_id
+    if spans:
+        response.headers['Server-Timing'] = ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans.items())
+    if profiler is not None:
+        response.headers['X-Profile-Path'] = stop_profiler(profiler, trace_id)
+    if elapsed > SLOW_REQUEST_SECONDS:
+        print(f"[{trace_id}] Медленный запрос {request.method} {request.path}: {elapsed:.2f} с; {format_spans(spans)}")
+    return response
+
+@app.teardown_request
+def drop_request_trace(error=None):
+    # после необработанного исключения after_request не вызывается
+    profiler = getattr(trace_context, 'profiler', None)
+    if profiler is not None:
+        trace_context.profiler = None
+        stop_profiler(profiler, current_trace_id() or uuid.uuid4().hex)
+    if current_trace_id() is not None:
+        end_trace()
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+@app.route('/metrics')
+def metrics():
+    lines = []
+    with metrics_lock:
+        snapshot = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in histograms.items())
+    previous_metric = None
+    for (metric, labels), histogram in snapshot:
+        if metric != previous_metric:
+            lines.append(f"# TYPE {metric} histogram")
+            previous_metric = metric
+        for bound, count in zip(METRIC_BUCKETS, histogram['buckets']):
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {count}")
+        lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{metric}_sum{prometheus_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{metric}_count{prometheus_labels(labels)} {histogram['count']}")
+
+    registry = model_registry.snapshot()
+    gauges = (
+        ('pinesnap_inference_queue_size', 'gauge', inference_queue.qsize()),
+        ('pinesnap_models_resident', 'gauge', len(registry['resident'])),
+        ('pinesnap_model_cache_hits_total', 'counter', registry['hits']),
+        ('pinesnap_model_cache_misses_total', 'counter', registry['misses']),
+        ('pinesnap_upload_duplicates_total', 'counter', upload_cache_stats['duplicates']),
+    )
+    for metric, metric_type, value in gauges:
+        lines.append(f"# TYPE {metric} {metric_type}")
+        lines.append(f"{metric} {value}")
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+process_locks = []
+
+def open_lock(name):
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    return open(os.path.join(LOCK_DIR, f"{name}.lock"), 'a+')
+
+def lock_file(handle, blocking=True):
+    if fcntl is not None:
+        fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+
+def unlock_file(handle):
+    if fcntl is not None:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(name):
+    # межпроцессная блокировка: потоковые Lock не видны другим воркерам WSGI
+    with open_lock(name) as handle:
+        lock_file(handle)
+        try:
+            yield
+        finally:
+            unlock_file(handle)
+
+def try_process_lock(name):
+    # блокировка держится до завершения процесса, чтобы роль досталась ровно одному воркеру
+    handle = open_lock(name)
+    try:
+        lock_file(handle, blocking=False)
+    except OSError:
+        handle.close()
+        return False
+    process_locks.append(handle)
+    return True
+
+@contextmanager
+def atomic_output(path):
+    # пишем во временный файл рядом и переименовываем: читатели не видят недописанный файл
+    root, extension = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}-{threading.get_ident()}.tmp{extension}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_imwrite(path, image):
+    with atomic_output(path) as tmp_path:
+        if not cv2.imwrite(tmp_path, image):
+            raise OSError(f"Не удалось записать изображение {path}")
+    return True
+
+def atomic_copy(source, destination):
+    with atomic_output(destination) as tmp_path:
+        shutil.copy2(source, tmp_path)
+
+
+class ModelRegistry:
+    def __init__(self, max_models):
+        self.max_models = max(1, max_models)
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        # загрузка идёт вне общего замка, чтобы не блокировать обращения к другим моделям и snapshot
+        self._loading = {}
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'reloads': 0, 'evictions': 0, 'load_time': 0.0, 'last_load_time': 0.0}
+
+    def resolve_path(self, model_id=None):
+        if model_id is None:
+            return DEFAULT_MODEL_PATH
+
+        entry = db.session.get(Model, model_id)
+        if entry is None:
+            raise KeyError(f"Модель {model_id} не найдена в базе данных.")
+
+        path = entry.model
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(__file__), path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'best.pt')
+        return path
+
+    def resolve_backend(self, model_id=None, backend=None):
+        weights_path = self.resolve_path(model_id)
+        if backend is None:
+            entry = db.session.get(Model, model_id) if model_id is not None else None
+            backend = (entry.backend if entry is not None else None) or INFERENCE_BACKEND
+
+        path = backend_path(weights_path, backend)
+        if backend != 'pytorch' and (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(weights_path)):
+            # экспорт отсутствует или устарел относительно весов
+            print(f"Бэкенд {backend} для {weights_path} недоступен, используется pytorch")
+            backend, path = 'pytorch', weights_path
+        return backend, path
+
+    def _load(self, path):
+        start = time.perf_counter()
+        with span('model_load'):
+            model = YOLO(path, task='detect')
+            # прогрев, чтобы первый запрос не платил за инициализацию
+            model.predict(np.zeros((64, 64, 3), dtype=np.uint8), verbose=False)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['loads'] += 1
+            self.stats['load_time'] += elapsed
+            self.stats['last_load_time'] = elapsed
+        print(f"Модель {path} загружена за {elapsed:.2f} с")
+        return model
+
+    def get(self, model_id=None, backend=None):
+        backend, path = self.resolve_backend(model_id, backend)
+        mtime = os.path.getmtime(path)
+        key = (model_id, backend)
+
+        with self._lock:
+            entry = self._lookup(key, path, mtime)
+            if entry is not None:
+                return entry
+            loading_lock = self._loading.setdefault(key, threading.Lock())
+
+        # одну и ту же модель грузит один поток, остальные дожидаются его результата
+        with loading_lock:
+            with self._lock:
+                entry = self._lookup(key, path, mtime)
+                if entry is not None:
+                    return entry
+                self.stats['misses'] += 1
+                if key in self._models:
+                    self.stats['reloads'] += 1
+
+            model = self._load(path)
+
+            with self._lock:
+                entry = {'model': model, 'path': path, 'mtime': mtime, 'backend': backend, 'lock': threading.Lock()}
+                self._models[key] = entry
+                self._models.move_to_end(key)
+
+                while len(self._models) > self.max_models:
+                    (evicted_id, evicted_backend), _ = self._models.popitem(last=False)
+                    self.stats['evictions'] += 1
+                    print(f"Модель {evicted_id or 'best.pt'} ({evicted_backend}) выгружена из памяти")
+                return entry
+
+    def _lookup(self, key, path, mtime):
+        entry = self._models.get(key)
+        if entry is not None and entry['path'] == path and entry['mtime'] == mtime:
+            self.stats['hits'] += 1
+            self._models.move_to_end(key)
+            return entry
+        return None
+
+    @contextmanager
+    def acquire(self, model_id=None, backend=None):
+        entry = self.get(model_id, backend)
+        with entry['lock']:
+            yield entry['model']
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['resident'] = [{'path': entry['path'], 'backend': entry['backend']} for entry in self._models.values()]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['avg_load_time'] = stats['load_time'] / stats['loads'] if stats['loads'] else 0.0
+        stats['max_models'] = self.max_models
+        return stats
+
+
+def backend_path(weights_path, backend):
+    # имена совпадают с теми, что создаёт экспорт ultralytics рядом с весами
+    stem = os.path.splitext(weights_path)[0]
+    if backend == 'onnx':
+        return stem + '.onnx'
+    if backend == 'openvino':
+        return stem + '_openvino_model'
+    if backend == 'openvino_int8':
+        return stem + '_int8_openvino_model'
+    return weights_path
+
+def export_weights(weights_path, backend, data=None):
+    options = dict(MODEL_BACKENDS[backend], dynamic=True)
+    if options.get('int8'):
+        if not data:
+            raise ValueError("Для INT8 нужен data.yaml датасета для калибровки.")
+        options.update(data=data, fraction=EXPORT_INT8_FRACTION)
+    exported = str(YOLO(weights_path).export(**options)).rstrip('/\\')
+    expected = backend_path(weights_path, backend)
+    if os.path.abspath(exported) != os.path.abspath(expected):
+        if os.path.isdir(expected):
+            shutil.rmtree(expected)
+        os.replace(exported, expected)
+    return expected
+
+model_registry = ModelRegistry(MODEL_CACHE_SIZE)
+
+
+def iter_video_frames(video_path, frame_rate=10):
     video_capture = cv2.VideoCapture(video_path)
-    video_filename = get_video_filename(video_path)
-    
+
     if not video_capture.isOpened():
         print("Ошибка: Не удалось открыть видео.")
         return
 
-    fps = video_capture.get(cv2.CAP_PROP_FPS)
-    frame_interval = int(fps * frame_rate) # для кадра надо делить
+    fps = video_capture.get(cv2.CAP_PROP_FPS) or 0
+    frame_interval = max(1, int(fps * frame_rate)) # для кадра надо делить
+    use_seek = frame_interval >= VIDEO_SEEK_THRESHOLD
     current_frame = 0
-    frame_count = 0
 
-    while True:
-        ret, frame = video_capture.read()
-        
-        if not ret:
-            break
-
-        if current_frame % frame_interval == 0:
-            frame_filename = f"{video_filename}_{frame_count:04d}.jpg"
+    try:
+        while True:
+            if use_seek and current_frame:
+                video_capture.set(cv2.CAP_PROP_POS_FRAMES, current_frame)
+
+            if not video_capture.grab():
+                break
+            ret, frame = video_capture.retrieve()
+            if not ret:
+                break
+
+            yield current_frame, (current_frame / fps if fps else 0.0), frame
+
+            if not use_seek:
+                # grab() только демультиплексирует пакет, кадр не декодируется в BGR
+                for _ in range(frame_interval - 1):
+                    if not video_capture.grab():
+                        return
+            current_frame += frame_interval
+    finally:
+        video_capture.release()
+
+def predict_video_frames(video_path, model_id=None, frame_rate=10, frames=None):
+    if frames is None:
+        frames = iter_video_frames(video_path, frame_rate)
+
+    with model_registry.acquire(model_id) as model:
+        for batch in iter_batches(frames, INFERENCE_BATCH_SIZE):
+            results = predict_images(model, [frame for _, _, frame in batch])
+            for (frame_index, timestamp, frame), result in zip(batch, results):
+                yield frame_index, timestamp, frame, result
+
+def perceptual_hash(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def iter_unique_frames(frames, stats):
+    previous_hash = None
+    for frame_index, timestamp, frame in frames:
+        frame_hash = perceptual_hash(frame)
+        if previous_hash is not None and (frame_hash ^ previous_hash).bit_count() <= VIDEO_DEDUP_DISTANCE:
+            stats['skipped'] += 1
+            continue
+        previous_hash = frame_hash
+        yield frame_index, timestamp, frame
+
+def extract_frames(video, job, frame_rate=VIDEO_FRAME_RATE, mode=None):
+    mode = mode or INFERENCE_MODE
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    video_path = os.path.join(static_folder, video.video)
+    output_folder = os.path.join(static_folder, "base_images", "frames", str(video.id))
+    processed_folder = processed_images_folder(job.model_id)
+    os.makedirs(output_folder, exist_ok=True)
+
+    stats = {'skipped': 0}
+    frames = iter_unique_frames(iter_video_frames(video_path, frame_rate), stats)
+    damage_filter = active_damage_filter(job.model_id)
+    if mode == 'memory':
+        # кадры сразу идут в модель; на диск пишутся все кадры, размеченная копия - только для кадров с повреждениями
+        frames = predict_video_frames(video_path, model_id=job.model_id, frames=frames)
+    else:
+        frames = ((frame_index, timestamp, frame, None) for frame_index, timestamp, frame in frames)
+
+    rows = []
+    frame_detections = {}
+    discovered = 0
+    pending = deque()
+    lease_refreshed = time.monotonic()
+    with ThreadPoolExecutor(max_workers=VIDEO_ENCODE_WORKERS) as executor:
+        for frame_index, timestamp, frame, result in frames:
+            if time.monotonic() - lease_refreshed > INFERENCE_LEASE_REFRESH:
+                refresh_job_lease(job)
+                lease_refreshed = time.monotonic()
+            frame_filename = f"{video.id}_{frame_index:07d}.jpg"
             frame_path = os.path.join(output_folder, frame_filename)
-            cv2.imwrite(frame_path, frame)
-            relative_path = os.path.relpath(frame_path, start=os.path.join(os.path.dirname(__file__), "static"))
-            relative_path = relative_path.replace("\\", "/")
-            file_creation_date = datetime.fromtimestamp(os.path.getctime(video_path))
-            new_photo = Photo(photo=relative_path, is_discovered=0, photo_date=file_creation_date)
-            db_session.add(new_photo)
-            frame_count += 1
-        
-        current_frame += 1
+            pending.append(executor.submit(atomic_imwrite, frame_path, frame))
+            row = {
+                'photo': os.path.relpath(frame_path, start=static_folder).replace("\\", "/"),
+                'is_discovered': 0,
+                'photo_date': video.video_date,
+                'modul': 0,
+                'job_id': job.id,
+                'video_id': video.id,
+                'frame_time': timestamp,
+            }
+            if result is not None:
+                row['processed_photo'] = row['photo']
+                if result_has_damage(result, damage_filter):
+                    processed_path = os.path.join(processed_folder, frame_filename)
+                    pending.append(executor.submit(atomic_imwrite, processed_path, result.plot()))
+                    row['is_discovered'] = 1
+                    row['processed_photo'] = os.path.relpath(processed_path, start=static_folder).replace("\\", "/")
+                    discovered += 1
+                frame_detections[row['photo']] = result_detections(result)
+            rows.append(row)
+
+            # ограничиваем число кадров, ожидающих кодирования, чтобы не держать всё видео в памяти
+            while len(pending) > VIDEO_ENCODE_WORKERS * 2:
+                pending.popleft().result()
+
+        for future in pending:
+            future.result()
+
+    if rows:
+        db.session.execute(insert(Photo), rows)
+        if frame_detections:
+            photo_ids = dict(db.session.execute(select(Photo.photo, Photo.id).where(Photo.video_id == video.id)).all())
+            insert_detections({photo_ids[path]: detections for path, detections in frame_detections.items()}, job.model_id or 0)
+        schedule_thumbnails(row['processed_photo'] for row in rows if row.get('is_discovered'))
+    video.frame_count = len(rows)
+    video.skipped_frames = stats['skipped']
+    job.total += len(rows)
+    if mode == 'memory':
+        job.processed += len(rows)
+        job.discovered += discovered
+    db.session.commit()
+    print(f"Извлечено {len(rows)} кадров из {video.video}, пропущено дубликатов: {stats['skipped']}.")
+
+def refresh_job_lease(job):
+    # updated_at меняется только при записи, а кадры видео сохраняются в базу одним пакетом в конце
+    db.session.execute(update(InferenceJob).where(InferenceJob.id == job.id).values(updated_at=datetime.now()))
+    db.session.commit()
+
+def get_counter(name, compute):
+    counter = db.session.get(CachedCounter, name)
+    if counter is None:
+        counter = CachedCounter(name=name, value=compute())
+        try:
+            db.session.add(counter)
+            db.session.commit()
+        except Exception:
+            # счётчик уже создан параллельным запросом
+            db.session.rollback()
+            counter = db.session.get(CachedCounter, name)
+    return counter.value
+
+def bump_counter(name, delta):
+    # вызывается в той же транзакции, что и изменение данных; несозданный счётчик будет посчитан при первом чтении
+    if delta:
+        db.session.execute(update(CachedCounter).where(CachedCounter.name == name).values(value=CachedCounter.value + delta))
+
+def count_labeled_photos():
+    return db.session.query(func.count(Photo.txt)).filter(Photo.txt.isnot(None), Photo.txt != '').scalar()
+
+def gallery_page(modul, before_id=None, limit=GALLERY_PAGE_SIZE):
+    query = Photo.query.filter(Photo.modul == modul)
+    if not modul:
+        query = query.filter(Photo.processed_photo.isnot(None), Photo.is_discovered.is_(True))
+    if before_id:
+        query = query.filter(Photo.id < before_id)
+
+    photos = query.order_by(Photo.id.desc()).limit(limit + 1).all()
+    next_before = photos[limit - 1].id if len(photos) > limit else None
+    return photos[:limit], next_before
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+thumbnail_cache_lock = threading.Lock()
+thumbnail_cache_bytes = None
+THUMBNAIL_FORMATS = {'webp': ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 80]), 'jpeg': ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 85])}
+
+def thumbnail_key(relative_path, size, image_format):
+    source_path = safe_join(os.path.join(os.path.dirname(__file__), "static"), relative_path)
+    if source_path is None or not os.path.isfile(source_path):
+        return None, None
+    source_stat = os.stat(source_path)
+    key = hashlib.sha1(f"{relative_path}:{source_stat.st_mtime_ns}:{source_stat.st_size}:{size}:{image_format}".encode()).hexdigest()
+    return source_path, key
+
+def thumbnail_path(key, image_format):
+    return os.path.join(THUMBNAIL_CACHE_DIR, key[:2], key + THUMBNAIL_FORMATS[image_format][0])
+
+def generate_thumbnail(relative_path, size, image_format):
+    source_path, key = thumbnail_key(relative_path, size, image_format)
+    if key is None:
+        return None, None
+
+    path = thumbnail_path(key, image_format)
+    if os.path.exists(path):
+        # время изменения служит отметкой последнего использования для LRU-вытеснения
+        os.utime(path)
+        return path, key
+
+    image = cv2.imread(source_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None, None
+
+    max_side = THUMBNAIL_SIZES[size]
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+    extension, _, params = THUMBNAIL_FORMATS[image_format]
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        return None, None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded.tobytes())
+    account_thumbnail_cache(len(encoded), keep=path)
+    return path, key
+
+def account_thumbnail_cache(added_bytes, keep=None):
+    global thumbnail_cache_bytes
+    with thumbnail_cache_lock:
+        if thumbnail_cache_bytes is None:
+            thumbnail_cache_bytes = sum(entry.stat().st_size for entry in iter_thumbnail_files())
+        else:
+            thumbnail_cache_bytes += added_bytes
+
+        if thumbnail_cache_bytes > THUMBNAIL_CACHE_MAX_BYTES:
+            thumbnail_cache_bytes = evict_thumbnails(int(THUMBNAIL_CACHE_MAX_BYTES * 0.9), keep)
+
+def iter_thumbnail_files():
+    if not os.path.isdir(THUMBNAIL_CACHE_DIR):
+        return
+    for bucket in os.scandir(THUMBNAIL_CACHE_DIR):
+        if bucket.is_dir():
+            for entry in os.scandir(bucket.path):
+                # недописанные файлы atomic_output: <имя>.<pid>-<поток>.tmp<расширение>
+                if entry.is_file() and '.tmp.' not in entry.name and not entry.name.endswith('.tmp'):
+                    yield entry
+
+def evict_thumbnails(target_bytes, keep=None):
+    entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in iter_thumbnail_files()))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in entries:
+        if total <= target_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            evicted += 1
+        except FileNotFoundError:
+            pass
+    print(f"Удалено миниатюр из кэша: {evicted}")
+    return total
+
+def schedule_thumbnails(relative_paths):
+    for relative_path in relative_paths:
+        for size in THUMBNAIL_PREWARM_SIZES:
+            if size in THUMBNAIL_SIZES:
+                for image_format in THUMBNAIL_FORMATS:
+                    thumbnail_executor.submit(generate_thumbnail, relative_path, size, image_format)
+
+@app.route('/thumbnails/<size>/<path:filename>')
+def thumbnail(size, filename):
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+
+    image_format = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    _, key = thumbnail_key(filename, size, image_format)
+    if key is None:
+        abort(404)
+
+    path = thumbnail_path(key, image_format)
+    if not os.path.exists(path):
+        # генерируем в потоке запроса: пул прогрева может быть занят тысячами заданий после большой загрузки
+        with span('thumbnail'):
+            path, key = generate_thumbnail(filename, size, image_format)
+        if path is None:
+            abort(404)
 
-    video_capture.release()
-    print(f"Извлечено {frame_count} кадров в папку '{output_folder}'.")
+    try:
+        # файл открывается сразу, чтобы параллельное вытеснение из кэша не помешало отдаче
+        thumbnail_file = open(path, 'rb')
+        os.utime(path)
+    except FileNotFoundError:
+        abort(503)
+
+    response = send_file(thumbnail_file, mimetype=THUMBNAIL_FORMATS[image_format][1], etag=key, max_age=THUMBNAIL_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.must_revalidate = True
+    response.vary.add('Accept')
+    return response
 
 @app.route('/')
 def index():
-    photos = Photo.query.filter_by(modul=0).order_by(Photo.id.desc()).all()
+    photos, next_before = gallery_page(0)
     models = Model.query.all()
-    return render_template('index.html', photos=photos, models=models)
+    return render_template('index.html', photos=photos, next_before=next_before, models=models)
+
+@app.route('/api/photos')
+def api_photos():
+    modul = request.args.get('modul', 0, type=int)
+    before_id = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 1), 500)
+
+    photos, next_before = gallery_page(modul, before_id, limit)
+    items = [{
+        'id': photo.id,
+        'filename': os.path.basename(photo.photo),
+        'photo': photo.photo,
+        'processed_photo': photo.processed_photo,
+        'txt': photo.txt,
+        'url': url_for('thumbnail', size='large', filename=photo.processed_photo or photo.photo),
+        'thumbnail_url': url_for('thumbnail', size='small', filename=photo.processed_photo or photo.photo),
+        'date': photo.photo_date.strftime('%d %B %Y'),
+    } for photo in photos]
+    return jsonify(items=items, next_before=next_before)
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
@@ -95,118 +950,957 @@ def upload_files():
         return "No file part", 400
     
     files = request.files.getlist('files')
-    filenames = []
-    output_folder = os.path.join(os.path.dirname(__file__), "runs", "predict")
+    model_id = request.form.get('selected_model', type=int)
     base_images_dir = os.path.join(os.path.dirname(__file__), "static", "base_images")
-    if not os.path.exists(base_images_dir):
-        os.makedirs(base_images_dir)
+    os.makedirs(base_images_dir, exist_ok=True)
 
+    stored_photos = {}
+    stored_videos = {}
     for file in files:
         if file.filename == '':
             return "No selected file", 400
         
         mime_type, _ = mimetypes.guess_type(file.filename)
+        with span('upload_save'):
+            content_hash, stored_path = save_by_content_hash(file, base_images_dir)
         if mime_type and mime_type.startswith('video/'):
-            video_path = os.path.join(base_images_dir, file.filename)
-            file.save(video_path)
-            extract_frames(video_path, output_folder, frame_rate=10, db_session=db.session)
+            stored_videos.setdefault(content_hash, stored_path)
         else:
-            filename = file.filename
-            photo = os.path.join(base_images_dir, filename)
-            file.save(photo)
-            relative_path = os.path.relpath(photo, start=os.path.join(os.path.dirname(__file__), "static")) 
-            relative_path = relative_path.replace("\\", "/")
-            file_creation_date = datetime.fromtimestamp(os.path.getctime(photo)) 
-            new_photo = Photo(photo=relative_path, is_discovered=0, photo_date=file_creation_date, modul=0)
-            db.session.add(new_photo)
-            filenames.append(filename)
+            stored_photos.setdefault(content_hash, stored_path)
+
+    job, known = register_gallery_files(stored_photos, stored_videos, model_id)
+    duplicates = len(files) - len(stored_photos) - len(stored_videos) + known
+    upload_cache_stats['duplicates'] += len(files) - len(stored_photos) - len(stored_videos)
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_id=job.id, status_url=url_for('job_status', job_id=job.id), duplicates=duplicates), 202
+    return redirect(url_for('index', job=job.id))
+
+def register_gallery_files(stored_photos, stored_videos, model_id=None):
+    # stored_*: хэш содержимого -> путь к сохранённому файлу
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    new_photos = []
+    new_videos = []
+    known_photos = {row.content_hash for row in db.session.query(Photo.content_hash).filter(Photo.modul == 0, Photo.content_hash.in_(list(stored_photos)))} if stored_photos else set()
+    known_videos = dict(db.session.query(Video.content_hash, Video.id).filter(Video.content_hash.in_(list(stored_videos)))) if stored_videos else {}
+    upload_cache_stats['duplicates'] += len(known_photos) + len(known_videos)
+
+    # файл и строка Photo не дублируются, но результат другой модели не подходит: такие фото прогоняются заново,
+    # а если эта модель их уже видела, ответ придёт из кэша детекций
+    rerun_ids = []
+    if known_photos or known_videos:
+        rerun_ids = [row.id for row in db.session.query(Photo.id)
+                     .outerjoin(InferenceJob, InferenceJob.id == Photo.job_id)
+                     .filter(
+                         Photo.modul == 0,
+                         or_(Photo.content_hash.in_(list(known_photos)), Photo.video_id.in_(list(known_videos.values()))),
+                         or_(InferenceJob.id.is_(None), func.coalesce(InferenceJob.model_id, 0) != (model_id or 0)),
+                     )]
+
+    for content_hash, video_path in stored_videos.items():
+        if content_hash in known_videos:
+            continue
+        relative_path = os.path.relpath(video_path, start=static_folder).replace("\\", "/")
+        video_creation_date = datetime.fromtimestamp(os.path.getctime(video_path))
+        new_video = Video(video=relative_path, video_date=video_creation_date, content_hash=content_hash)
+        db.session.add(new_video)
+        new_videos.append(new_video)
+
+    for content_hash, photo in stored_photos.items():
+        if content_hash in known_photos:
+            continue
+        relative_path = os.path.relpath(photo, start=static_folder).replace("\\", "/")
+        file_creation_date = datetime.fromtimestamp(os.path.getctime(photo)) 
+        new_photo = Photo(photo=relative_path, is_discovered=0, photo_date=file_creation_date, modul=0, content_hash=content_hash)
+        db.session.add(new_photo)
+        new_photos.append(new_photo)
+
+    job = InferenceJob(status='queued', model_id=model_id, total=len(new_photos) + len(rerun_ids))
+    db.session.add(job)
+    db.session.flush()
+    for new_item in new_photos + new_videos:
+        new_item.job_id = job.id
+    for ids in iter_batches(rerun_ids, MODEL_UPLOAD_QUERY_BATCH):
+        db.session.execute(
+            update(Photo).where(Photo.id.in_(ids)).values(job_id=job.id, processed_photo=None, is_discovered=0)
+            .execution_options(synchronize_session=False)
+        )
+    with span('db_flush'):
+        db.session.commit()
+    print(f"[{current_trace_id()}] Задание {job.id} поставлено в очередь")
+    enqueue_inference_job(job.id)
+    return job, len(known_photos) + len(known_videos)
+
+upload_cache_stats = {'duplicates': 0, 'hits': 0, 'misses': 0}
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def save_by_content_hash(file, folder):
+    # хэш считается по мере записи, файл сохраняется под именем <sha256><расширение>
+    extension = os.path.splitext(file.filename)[1].lower()
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f".upload-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}.tmp")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+
+        return digest.hexdigest(), move_to_content_path(tmp_path, folder, digest.hexdigest(), extension)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def move_to_content_path(tmp_path, folder, content_hash, extension):
+    destination_folder = os.path.join(folder, content_hash[:2])
+    os.makedirs(destination_folder, exist_ok=True)
+    destination_path = os.path.join(destination_folder, content_hash + extension)
+    if os.path.exists(destination_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, destination_path)
+    return destination_path
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_folder(kind):
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    return os.path.join(static_folder, "model_images" if kind == 'model' else "base_images")
+
+def upload_part_path(upload):
+    return os.path.join(upload_folder(upload.kind), ".partial", upload.id)
+
+def upload_state(upload):
+    received = [row.chunk_index for row in db.session.query(UploadChunk.chunk_index).filter(UploadChunk.upload_id == upload.id).order_by(UploadChunk.chunk_index)]
+    received_set = set(received)
+    return {
+        'upload_id': upload.id,
+        'filename': upload.filename,
+        'status': upload.status,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received_chunks': received,
+        'missing_chunks': [index for index in range(upload.total_chunks) if index not in received_set],
+        'job_id': upload.job_id,
+        'error': upload.error,
+    }
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    payload = request.get_json(silent=True) or request.form
+    filename = os.path.basename(payload.get('filename') or '')
+    kind = payload.get('kind', 'photo')
+    try:
+        size = int(payload.get('size'))
+        chunk_size = min(int(payload.get('chunk_size') or RESUMABLE_CHUNK_SIZE), RESUMABLE_MAX_CHUNK_SIZE)
+        model_id = int(payload['selected_model']) if payload.get('selected_model') else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Необходимо указать размер файла и размер фрагмента."}), 400
+
+    if not filename:
+        return jsonify({"error": "Необходимо указать имя файла."}), 400
+    if kind not in ('photo', 'model'):
+        return jsonify({"error": f"Неизвестный тип загрузки: {kind}"}), 400
+    if size <= 0 or chunk_size <= 0:
+        return jsonify({"error": "Размер файла и фрагмента должен быть больше 0."}), 400
+
+    upload = Upload(
+        id=uuid.uuid4().hex,
+        filename=filename,
+        kind=kind,
+        size=size,
+        chunk_size=chunk_size,
+        total_chunks=(size + chunk_size - 1) // chunk_size,
+        sha256=payload.get('sha256'),
+        model_id=model_id,
+    )
+    part_path = upload_part_path(upload)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
 
+    db.session.add(upload)
     db.session.commit()
-    run_yolo_predictions()
+    return jsonify(upload_state(upload)), 201
+
+@app.route('/uploads/<upload_id>')
+def upload_status(upload_id):
+    upload = db.session.get(Upload, upload_id)
+    if upload is None:
+        return jsonify({"error": "Загрузка не найдена."}), 404
+    return jsonify(upload_state(upload))
+
+@app.route('/uploads/<upload_id>/chunks/<int:chunk_index>', methods=['PUT'])
+def upload_chunk(upload_id, chunk_index):
+    upload = db.session.get(Upload, upload_id)
+    if upload is None:
+        return jsonify({"error": "Загрузка не найдена."}), 404
+    if upload.status != 'uploading':
+        return jsonify(upload_state(upload)), 409
+    if not 0 <= chunk_index < upload.total_chunks:
+        return jsonify({"error": f"Недопустимый номер фрагмента: {chunk_index}"}), 400
+
+    offset = chunk_index * upload.chunk_size
+    expected_length = min(upload.chunk_size, upload.size - offset)
+    expected_checksum = (request.headers.get('X-Chunk-SHA256') or '').lower()
+    if not expected_checksum:
+        return jsonify({"error": "Не передан заголовок X-Chunk-SHA256."}), 400
+
+    # фрагмент пишется сразу на своё место в итоговом файле, без буферизации в памяти
+    digest = hashlib.sha256()
+    written = 0
+    with span('upload_chunk_write'), open(upload_part_path(upload), 'r+b') as f:
+        f.seek(offset)
+        while written < expected_length:
+            block = request.stream.read(min(UPLOAD_CHUNK_SIZE, expected_length - written))
+            if not block:
+                break
+            digest.update(block)
+            f.write(block)
+            written += len(block)
+
+    if written != expected_length or request.stream.read(1):
+        return jsonify({"error": f"Ожидалось {expected_length} байт во фрагменте {chunk_index}."}), 400
+    if digest.hexdigest() != expected_checksum:
+        return jsonify({"error": f"Контрольная сумма фрагмента {chunk_index} не совпадает."}), 422
 
-    return redirect(url_for('index'))
+    try:
+        db.session.add(UploadChunk(upload_id=upload.id, chunk_index=chunk_index, checksum=expected_checksum))
+        db.session.commit()
+    except Exception:
+        # повторная отправка уже принятого фрагмента
+        db.session.rollback()
 
-def run_yolo_predictions():
-    model_path = os.path.join(os.path.dirname(__file__), "static", "best.pt")
-    model = YOLO(model_path)
+    received = UploadChunk.query.filter_by(upload_id=upload.id).count()
+    if received == upload.total_chunks:
+        finish_upload(upload)
+    return jsonify(upload_state(upload))
 
-    predicted_folder = os.path.join(os.path.dirname(__file__), "runs", "predict")
-    os.makedirs(predicted_folder, exist_ok=True)
+def finish_upload(upload):
+    claimed = db.session.execute(
+        update(Upload).where(Upload.id == upload.id, Upload.status == 'uploading').values(status='assembling')
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
 
-    photos = Photo.query.filter(Photo.processed_photo.is_(None), Photo.modul == 0).all()
-    for photo in photos:
-        image_path = os.path.join(os.path.dirname(__file__), "static", photo.photo)
-        destination_path = os.path.join(predicted_folder, os.path.basename(photo.photo))
+    part_path = upload_part_path(upload)
+    folder = upload_folder(upload.kind)
+    try:
+        content_hash = file_sha256(part_path)
+        if upload.sha256 and upload.sha256.lower() != content_hash:
+            raise ValueError("Контрольная сумма файла не совпадает.")
 
-        if os.path.exists(image_path):
-            if os.path.abspath(image_path) == os.path.abspath(destination_path):
-                print(f"Skipping copy for {image_path}, as it is the same file as {destination_path}.")
+        if upload.kind == 'model':
+            os.replace(part_path, os.path.join(folder, upload.filename))
+            register_model_files([upload.filename])
+        else:
+            extension = os.path.splitext(upload.filename)[1].lower()
+            stored_path = move_to_content_path(part_path, folder, content_hash, extension)
+            mime_type, _ = mimetypes.guess_type(upload.filename)
+            if mime_type and mime_type.startswith('video/'):
+                job, _ = register_gallery_files({}, {content_hash: stored_path}, upload.model_id)
             else:
+                job, _ = register_gallery_files({content_hash: stored_path}, {}, upload.model_id)
+            upload.job_id = job.id
+
+        upload.status = 'complete'
+    except Exception as e:
+        db.session.rollback()
+        upload.status = 'failed'
+        upload.error = str(e)
+        print(f"Ошибка при завершении загрузки {upload.id}: {e}")
+    db.session.commit()
+
+inference_queue = queue.Queue()
+inference_workers = []
+inference_workers_lock = threading.Lock()
+
+def start_inference_workers():
+    with inference_workers_lock:
+        if inference_workers:
+            return
+
+        if TILED_INFERENCE and INFERENCE_MODE != 'memory':
+            # дисковый режим отдаёт модели целую папку, нарезка на тайлы работает только в памяти
+            print("TILED_INFERENCE=1 действует только при INFERENCE_MODE=memory, изображения обрабатываются целиком")
+
+        with app.app_context():
+            requeue_pending_photos()
+
+        for i in range(max(1, INFERENCE_WORKERS)):
+            worker = threading.Thread(target=inference_worker, name=f"inference-worker-{i}", daemon=True)
+            worker.start()
+            inference_workers.append(worker)
+
+def enqueue_inference_job(job_id):
+    start_inference_workers()
+    inference_queue.put(job_id)
+
+def requeue_pending_photos():
+    # running-задания других воркеров не трогаем, пока их срок аренды не истёк
+    active_jobs = InferenceJob.query.filter(InferenceJob.status.in_(['queued', 'running'])).all()
+    lease_expired = datetime.now().timestamp() - INFERENCE_JOB_LEASE
+    stale_jobs = [job for job in active_jobs if job.status == 'queued' or job.updated_at.timestamp() < lease_expired]
+    for job in stale_jobs:
+        job.status = 'queued'
+
+    active_ids = [job.id for job in active_jobs]
+    orphans_query = Photo.query.filter(Photo.processed_photo.is_(None), Photo.modul == 0)
+    if active_ids:
+        orphans_query = orphans_query.filter(or_(Photo.job_id.is_(None), Photo.job_id.notin_(active_ids)))
+    orphans = orphans_query.all()
+
+    videos_query = Video.query.filter(Video.frame_count.is_(None))
+    if active_ids:
+        videos_query = videos_query.filter(or_(Video.job_id.is_(None), Video.job_id.notin_(active_ids)))
+    orphan_videos = videos_query.all()
+
+    if orphans or orphan_videos:
+        job = InferenceJob(status='queued', total=len(orphans))
+        db.session.add(job)
+        db.session.flush()
+        for item in orphans + orphan_videos:
+            item.job_id = job.id
+        stale_jobs.append(job)
+
+    db.session.commit()
+    for job in stale_jobs:
+        inference_queue.put(job.id)
+    if stale_jobs:
+        print(f"Повторно поставлено в очередь заданий: {len(stale_jobs)}")
+
+def inference_worker():
+    while True:
+        job_id = inference_queue.get()
+        begin_trace(f"job-{job_id}")
+        try:
+            with app.app_context():
+                process_inference_job(job_id)
+        except Exception as e:
+            print(f"Ошибка в обработчике задания {job_id}: {e}")
+        finally:
+            elapsed, spans = end_trace()
+            observe('pinesnap_job_seconds', elapsed, kind='inference')
+            print(f"[job-{job_id}] Задание обработано за {elapsed:.2f} с; {format_spans(spans)}")
+            inference_queue.task_done()
+
+def process_inference_job(job_id):
+    claimed = db.session.execute(
+        update(InferenceJob)
+        .where(InferenceJob.id == job_id, InferenceJob.status == 'queued')
+        .values(status='running', updated_at=datetime.now())
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+
+    job = db.session.get(InferenceJob, job_id)
+    last_id = 0
+    try:
+        for video in Video.query.filter(Video.job_id == job.id, Video.frame_count.is_(None)).all():
+            with span('frame_extraction'):
+                extract_frames(video, job)
+
+        while True:
+            photos = Photo.query.filter(
+                Photo.job_id == job.id,
+                Photo.processed_photo.is_(None),
+                Photo.modul == 0,
+                Photo.id > last_id,
+            ).order_by(Photo.id).limit(INFERENCE_BATCH_SIZE).all()
+            if not photos:
+                break
+
+            last_id = photos[-1].id
+            batch_size = len(photos)
+            discovered = run_yolo_predictions(photos, model_id=job.model_id)
+            job.processed += batch_size
+            job.discovered += discovered
+            db.session.commit()
+
+        job.status = 'done'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job.status = 'failed'
+        job.error = str(e)
+        db.session.commit()
+        print(f"Задание {job.id} завершилось с ошибкой: {e}")
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = db.session.get(InferenceJob, job_id)
+    if job is None:
+        return jsonify({"error": "Задание не найдено."}), 404
+
+    return jsonify(
+        id=job.id,
+        status=job.status,
+        model_id=job.model_id,
+        total=job.total,
+        processed=job.processed,
+        discovered=job.discovered,
+        remaining=max(job.total - job.processed, 0),
+        error=job.error,
+        created_at=job.created_at.isoformat(),
+        updated_at=job.updated_at.isoformat(),
+    )
+
+inference_io_stats = {
+    mode: {'runs': 0, 'images': 0, 'files_read': 0, 'bytes_read': 0, 'files_written': 0, 'bytes_written': 0, 'seconds': 0.0}
+    for mode in ('disk', 'memory')
+}
+
+def count_io(stats, read_path=None, written_path=None):
+    if read_path is not None:
+        stats['files_read'] += 1
+        stats['bytes_read'] += os.path.getsize(read_path)
+    if written_path is not None:
+        stats['files_written'] += 1
+        stats['bytes_written'] += os.path.getsize(written_path)
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def active_damage_filter(model_id=None):
+    # класс и порог, заданные последней перефильтрацией; без неё - значения из окружения
+    damage_filter = db.session.get(DamageFilter, model_id or 0)
+    if damage_filter is None:
+        return DAMAGE_CLASS, DAMAGE_MIN_CONFIDENCE
+    return damage_filter.class_name, damage_filter.min_confidence
+
+def processed_images_folder(model_id=None):
+    # у каждой модели своя папка: кэш детекций по (хэш, модель) ссылается на изображение, размеченное именно ею
+    folder = os.path.join(os.path.dirname(__file__), "static", "images", str(model_id or 0))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def result_has_damage(result, damage_filter=None):
+    if result.boxes is None or len(result.boxes) == 0:
+        return False
+    class_name, min_confidence = damage_filter or (DAMAGE_CLASS, DAMAGE_MIN_CONFIDENCE)
+    return any(
+        result.names[int(class_id)] == class_name and confidence >= min_confidence
+        for class_id, confidence in zip(result.boxes.cls.tolist(), result.boxes.conf.tolist())
+    )
+
+def result_detections(result):
+    if result.boxes is None or len(result.boxes) == 0:
+        return []
+    return [
+        {'class_id': int(class_id), 'class_name': result.names[int(class_id)], 'confidence': confidence, 'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}
+        for class_id, confidence, (x1, y1, x2, y2) in zip(result.boxes.cls.tolist(), result.boxes.conf.tolist(), result.boxes.xyxy.tolist())
+    ]
+
+def predict_images(model, images):
+    if TILED_INFERENCE:
+        return [predict_tiled(model, image) for image in images]
+    results = model.predict(images, batch=len(images), verbose=False)
+    record_result_speed(results)
+    return results
+
+def tile_origins(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def predict_tiled(model, image, tile_size=None, overlap=None, batch_size=None, include_full_frame=None):
+    tile_size = tile_size or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    batch_size = batch_size or TILE_BATCH_SIZE
+    include_full_frame = TILE_INCLUDE_FULL_FRAME if include_full_frame is None else include_full_frame
+
+    height, width = image.shape[:2]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    tiles = [(x, y) for y in tile_origins(height, tile_size, stride) for x in tile_origins(width, tile_size, stride)]
+    crops = ((x, y, image[y:y + tile_size, x:x + tile_size]) for x, y in tiles)
+
+    detections = []
+    names = None
+    for batch in iter_batches(crops, batch_size):
+        results = model.predict([crop for _, _, crop in batch], batch=len(batch), imgsz=tile_size, verbose=False)
+        record_result_speed(results)
+        for (x, y, _), result in zip(batch, results):
+            names = result.names
+            if result.boxes is not None and len(result.boxes):
+                data = result.boxes.data.clone()
+                data[:, :4] += data.new_tensor([x, y, x, y])
+                detections.append(data)
+
+    if include_full_frame and len(tiles) > 1:
+        result = model.predict(image, verbose=False)[0]
+        record_result_speed([result])
+        names = result.names
+        if result.boxes is not None and len(result.boxes):
+            detections.append(result.boxes.data.clone())
+
+    if detections:
+        data = torch.cat([detection.cpu() for detection in detections])
+        keep = batched_nms(data[:, :4], data[:, 4], data[:, 5], TILE_NMS_IOU)
+        data = data[keep]
+    else:
+        data = torch.zeros((0, 6))
+
+    return Results(orig_img=image, path='', names=names or model.names, boxes=data)
+
+def run_yolo_predictions(photos=None, model_id=None, mode=None):
+    mode = mode or INFERENCE_MODE
+    if photos is None:
+        photos = Photo.query.filter(Photo.processed_photo.is_(None), Photo.modul == 0).all()
+    if not photos:
+        return 0
+
+    cache_model_id = model_id or 0
+    # кэш результатов привязан к файлу конкретного бэкенда: смена бэкенда его сбрасывает
+    model_mtime = os.path.getmtime(model_registry.resolve_backend(model_id)[1])
+    # строка Photo одна на содержимое, поэтому детекции этой модели у неё уже есть с прошлого прогона
+    outcomes = lookup_detection_cache(photos, cache_model_id, model_mtime)
+    pending = [photo for photo in photos if photo.id not in outcomes]
+    detections = {}
+
+    if pending:
+        stats = inference_io_stats[mode]
+        start = time.perf_counter()
+        with span(f'predict_{mode}'):
+            if mode == 'memory':
+                predicted, detections = predict_in_memory(pending, model_id, stats)
+            else:
+                predicted, detections = predict_on_disk(pending, model_id, stats)
+
+        stats['runs'] += 1
+        stats['images'] += len(pending)
+        stats['seconds'] += time.perf_counter() - start
+        outcomes.update(predicted)
+        hashes = {photo.id: photo.content_hash for photo in pending if photo.content_hash}
+    else:
+        hashes = {}
+
+    discovered = apply_prediction_results(outcomes, detections, cache_model_id)
+    store_detection_cache(hashes, outcomes, cache_model_id, model_mtime)
+    return discovered
+
+def lookup_detection_cache(photos, cache_model_id, model_mtime):
+    hashed = {}
+    for photo in photos:
+        if photo.content_hash:
+            hashed.setdefault(photo.content_hash, []).append(photo)
+    if not hashed:
+        return {}
+
+    entries = DetectionCache.query.filter(
+        DetectionCache.model_id == cache_model_id,
+        DetectionCache.model_mtime == model_mtime,
+        DetectionCache.image_hash.in_(list(hashed)),
+    ).all()
+
+    outcomes = {}
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    model_prefix = f"images/{cache_model_id}/"
+    for entry in entries:
+        if entry.processed_photo and not entry.processed_photo.startswith(model_prefix):
+            # запись из общей папки images/: изображение могла перезаписать другая модель
+            continue
+        if entry.processed_photo and not os.path.exists(os.path.join(static_folder, entry.processed_photo)):
+            continue
+        for photo in hashed[entry.image_hash]:
+            outcomes[photo.id] = entry.processed_photo
+
+    upload_cache_stats['hits'] += len(outcomes)
+    upload_cache_stats['misses'] += sum(len(group) for group in hashed.values()) - len(outcomes)
+    return outcomes
+
+def store_detection_cache(hashes, outcomes, cache_model_id, model_mtime):
+    rows = {}
+    for photo_id, content_hash in hashes.items():
+        if photo_id in outcomes:
+            rows[content_hash] = {
+                'image_hash': content_hash,
+                'model_id': cache_model_id,
+                'model_mtime': model_mtime,
+                'processed_photo': outcomes[photo_id],
+                'created_at': datetime.now(),
+            }
+    if not rows:
+        return
+
+    try:
+        db.session.execute(delete(DetectionCache).where(DetectionCache.model_id == cache_model_id, DetectionCache.image_hash.in_(list(rows))))
+        db.session.execute(insert(DetectionCache), list(rows.values()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Не удалось сохранить кэш детекций: {e}")
+
+def predict_in_memory(photos, model_id, stats):
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    destination_folder = processed_images_folder(model_id)
+
+    def decoded_photos():
+        for photo in photos:
+            image_path = os.path.join(static_folder, photo.photo)
+            image = cv2.imread(image_path)
+            if image is None:
+                print(f"Error: The image path {image_path} does not exist.")
+                continue
+            count_io(stats, read_path=image_path)
+            yield photo, image
+
+    outcomes = {}
+    detections = {}
+    damage_filter = active_damage_filter(model_id)
+    with model_registry.acquire(model_id) as model:
+        for batch in iter_batches(decoded_photos(), INFERENCE_BATCH_SIZE):
+            results = predict_images(model, [image for _, image in batch])
+
+            for (photo, _), result in zip(batch, results):
+                detections[photo.id] = result_detections(result)
+                if result_has_damage(result, damage_filter):
+                    processed_image_path = os.path.join(destination_folder, os.path.basename(photo.photo))
+                    with span('image_write'):
+                        atomic_imwrite(processed_image_path, result.plot())
+                    count_io(stats, written_path=processed_image_path)
+                    outcomes[photo.id] = os.path.relpath(processed_image_path, start=static_folder).replace("\\", "/")
+                else:
+                    outcomes[photo.id] = None
+
+    return outcomes, detections
+
+def insert_detections(detections, model_id):
+    rows = [
+        dict(detection, photo_id=photo_id, model_id=model_id)
+        for photo_id, photo_detections in detections.items()
+        for detection in photo_detections
+    ]
+    if detections:
+        db.session.execute(delete(Detection).where(Detection.photo_id.in_(list(detections)), Detection.model_id == model_id))
+    if rows:
+        db.session.execute(insert(Detection), rows)
+
+def apply_prediction_results(outcomes, detections=None, model_id=0):
+    # outcomes: id фотографии -> путь к обработанному изображению или None, если повреждений нет
+    discovered = [{'id': photo_id, 'is_discovered': 1, 'processed_photo': path} for photo_id, path in outcomes.items() if path]
+    rejected = [photo_id for photo_id, path in outcomes.items() if not path]
+
+    try:
+        with span('db_flush'):
+            if discovered:
+                db.session.bulk_update_mappings(Photo, discovered)
+            if rejected:
+                # фотографии без повреждений остаются в базе вместе с детекциями, чтобы их можно было перефильтровать
+                db.session.execute(
+                    update(Photo).where(Photo.id.in_(rejected)).values(is_discovered=0, processed_photo=Photo.photo)
+                    .execution_options(synchronize_session=False)
+                )
+            if detections:
+                insert_detections(detections, model_id)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    schedule_thumbnails(mapping['processed_photo'] for mapping in discovered)
+    return len(discovered)
+
+def predict_on_disk(photos, model_id, stats):
+    # у каждого вызова своя папка: параллельные задания и процессы не перемешивают свои пакеты
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    run = tempfile.mkdtemp(prefix="predict-", dir=SCRATCH_DIR)
+    try:
+        return predict_in_scratch(photos, model_id, stats, run)
+    finally:
+        shutil.rmtree(run, ignore_errors=True)
+
+def predict_in_scratch(photos, model_id, stats, run):
+    predicted_folder = os.path.join(run, "predict")
+    os.makedirs(predicted_folder, exist_ok=True)
+
+    with span('file_copy'):
+        for photo in photos:
+            image_path = os.path.join(os.path.dirname(__file__), "static", photo.photo)
+            destination_path = os.path.join(predicted_folder, os.path.basename(photo.photo))
+
+            if os.path.exists(image_path):
                 try:
                     shutil.copy(image_path, destination_path)
+                    count_io(stats, read_path=image_path, written_path=destination_path)
                     print(f"Copied {image_path} to {destination_path}.")
                 except Exception as e:
                     print(f"Failed to copy {image_path} to {destination_path}: {e}")
-        else:
-            print(f"Error: The image path {image_path} does not exist.")
-
-    results = model.predict(predicted_folder, save=True)
-    predicted_model_folder = os.path.join(os.path.dirname(__file__), "runs", "detect", "predict")
-    run = os.path.join(os.path.dirname(__file__), "runs")
-    destination_folder = os.path.join(os.path.dirname(__file__), "static", "images")
-    destination_base_folder = os.path.join(os.path.dirname(__file__), "static", "base_images")
-    os.makedirs(destination_folder, exist_ok=True)
+            else:
+                print(f"Error: The image path {image_path} does not exist.")
 
+    predicted_model_folder = os.path.join(run, "detect", "predict")
+    with model_registry.acquire(model_id) as model:
+        results = model.predict(predicted_folder, save=True, project=os.path.dirname(predicted_model_folder), name="predict", exist_ok=True)
+    record_result_speed(results)
     for item in os.listdir(predicted_folder):
-        source = os.path.join(predicted_folder, item)
-        destination = os.path.join(destination_base_folder, item)
-        shutil.copy2(source, destination)
-
+        count_io(stats, read_path=os.path.join(predicted_folder, item))
     for item in os.listdir(predicted_model_folder):
-        source = os.path.join(predicted_model_folder, item)
-        destination = os.path.join(destination_folder, item)
-        shutil.copy2(source, destination)
-
+        count_io(stats, written_path=os.path.join(predicted_model_folder, item))
+    destination_folder = processed_images_folder(model_id)
+
+    with span('file_copy'):
+        for item in os.listdir(predicted_model_folder):
+            source = os.path.join(predicted_model_folder, item)
+            destination = os.path.join(destination_folder, item)
+            atomic_copy(source, destination)
+            count_io(stats, read_path=source, written_path=destination)
+
+    results_by_path = {os.path.normpath(result.path): result for result in results}
+    damage_filter = active_damage_filter(model_id)
+    outcomes = {}
+    detections = {}
     for photo in photos:
         processed_image_path = os.path.join(destination_folder, os.path.basename(photo.photo))
-            
+
         if os.path.exists(processed_image_path):
-            damage_detected = False
-            for result in results:
-                if result.path == os.path.join(predicted_folder, os.path.basename(photo.photo)):
-                    if result.boxes is not None and len(result.boxes) > 0:
-                        for box in result.boxes:
-                            class_id = int(box.cls)
-                            is_discovered = result.names[class_id]
-                            if is_discovered == 'BadTree':
-                                damage_detected = True
-                                break
-                    break 
-
-            if damage_detected:
-                photo.is_discovered = 1
+            result = results_by_path.get(os.path.normpath(os.path.join(predicted_folder, os.path.basename(photo.photo))))
+            if result is not None:
+                detections[photo.id] = result_detections(result)
+            if result is not None and result_has_damage(result, damage_filter):
                 relative_processed_path = os.path.relpath(processed_image_path, start=os.path.join(os.path.dirname(__file__), "static"))
-                relative_processed_path = relative_processed_path.replace("\\", "/")
-                photo.processed_photo = relative_processed_path
+                outcomes[photo.id] = relative_processed_path.replace("\\", "/")
             else:
-                photo.is_discovered = 0
-                db.session.delete(photo)
+                outcomes[photo.id] = None
+
+    return outcomes, detections
+
+def photo_model_id():
+    # модель, чей результат сейчас показан у фотографии: модель её последнего задания инференса
+    return func.coalesce(select(InferenceJob.model_id).where(InferenceJob.id == Photo.job_id).scalar_subquery(), 0)
+
+def discovered_photos_query(class_name=None, min_confidence=None, model_id=None):
+    active_class, active_confidence = active_damage_filter(model_id)
+    class_name = class_name or active_class
+    min_confidence = active_confidence if min_confidence is None else min_confidence
+    matching = select(Detection.photo_id).where(Detection.class_name == class_name, Detection.confidence >= min_confidence)
+    query = Photo.query.filter(Photo.modul == 0)
+    if model_id is not None:
+        matching = matching.where(Detection.model_id == model_id)
+        query = query.filter(photo_model_id() == model_id)
+    return query.filter(Photo.id.in_(matching))
+
+@app.route('/api/detections')
+def api_detections():
+    model_id = request.args.get('model_id', type=int)
+    active_class, active_confidence = active_damage_filter(model_id)
+    class_name = request.args.get('class', active_class)
+    min_confidence = request.args.get('min_confidence', active_confidence, type=float)
+    before_id = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 1), 500)
+
+    query = discovered_photos_query(class_name, min_confidence, model_id)
+    if before_id:
+        query = query.filter(Photo.id < before_id)
+    photos = query.order_by(Photo.id.desc()).limit(limit + 1).all()
+    next_before = photos[limit - 1].id if len(photos) > limit else None
+    photos = photos[:limit]
+
+    boxes = {}
+    if photos:
+        detections = Detection.query.filter(
+            Detection.photo_id.in_([photo.id for photo in photos]),
+            Detection.class_name == class_name,
+            Detection.confidence >= min_confidence,
+        )
+        if model_id is not None:
+            detections = detections.filter(Detection.model_id == model_id)
+        for detection in detections:
+            boxes.setdefault(detection.photo_id, []).append({
+                'model_id': detection.model_id,
+                'confidence': detection.confidence,
+                'xyxy': [detection.x1, detection.y1, detection.x2, detection.y2],
+            })
+
+    items = [{'id': photo.id, 'photo': photo.photo, 'processed_photo': photo.processed_photo, 'detections': boxes.get(photo.id, [])} for photo in photos]
+    return jsonify(items=items, next_before=next_before)
+
+def render_stored_detections(photos, model_id):
+    # размеченное изображение по сохранённым детекциям, без повторного инференса
+    static_folder = os.path.join(os.path.dirname(__file__), "static")
+    destination_folder = processed_images_folder(model_id)
+
+    boxes = {}
+    names = {}
+    for detection in Detection.query.filter(Detection.photo_id.in_([photo.id for photo in photos]), Detection.model_id == model_id):
+        boxes.setdefault(detection.photo_id, []).append([detection.x1, detection.y1, detection.x2, detection.y2, detection.confidence, detection.class_id])
+        names[detection.class_id] = detection.class_name
+
+    processed = {}
+    for photo in photos:
+        image = cv2.imread(os.path.join(static_folder, photo.photo))
+        if image is None:
+            print(f"Error: The image path {photo.photo} does not exist.")
+            continue
+        result = Results(orig_img=image, path=photo.photo, names=names, boxes=torch.tensor(boxes[photo.id]))
+        processed_image_path = os.path.join(destination_folder, os.path.basename(photo.photo))
+        with span('image_write'):
+            atomic_imwrite(processed_image_path, result.plot())
+        processed[photo.id] = os.path.relpath(processed_image_path, start=static_folder).replace("\\", "/")
+    return processed
+
+@app.route('/detections/refilter', methods=['POST'])
+def refilter_detections():
+    model_id = request.form.get('selected_model', 0, type=int)
+    active_class, active_confidence = active_damage_filter(model_id)
+    class_name = request.form.get('class_name', active_class)
+    min_confidence = request.form.get('min_confidence', active_confidence, type=float)
+
+    # перефильтровываются только фотографии, последний результат которых получен этой моделью, и только по её детекциям
+    in_scope = (Photo.modul == 0, Photo.processed_photo.isnot(None), photo_model_id() == model_id)
+    matching = exists().where(
+        Detection.photo_id == Photo.id,
+        Detection.model_id == model_id,
+        Detection.class_name == class_name,
+        Detection.confidence >= min_confidence,
+    )
 
-            db.session.commit()
+    # у фотографий, прежде не прошедших фильтр, вместо размеченного изображения лежит исходное
+    unannotated = Photo.query.filter(*in_scope, matching, Photo.processed_photo == Photo.photo).all()
+    processed = {}
+    for batch in iter_batches(unannotated, INFERENCE_BATCH_SIZE):
+        processed.update(render_stored_detections(batch, model_id))
 
-    if os.path.exists(run):
-        shutil.rmtree(run)
+    try:
+        db.session.execute(
+            update(Photo)
+            .where(*in_scope)
+            .values(is_discovered=matching)
+            .execution_options(synchronize_session=False)
+        )
+        if processed:
+            db.session.bulk_update_mappings(Photo, [{'id': photo_id, 'processed_photo': path} for photo_id, path in processed.items()])
+        if (class_name, min_confidence) != (active_class, active_confidence):
+            db.session.merge(DamageFilter(model_id=model_id, class_name=class_name, min_confidence=min_confidence))
+            # в кэше лежат решения по старому фильтру
+            db.session.execute(delete(DetectionCache).where(DetectionCache.model_id == model_id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Не удалось обновить отметки: {str(e)}"}), 500
+
+    schedule_thumbnails(processed.values())
+    discovered = Photo.query.filter(*in_scope, Photo.is_discovered.is_(True)).count()
+    return jsonify(model_id=model_id, class_name=class_name, min_confidence=min_confidence, discovered=discovered)
 
 
+@app.route('/stats')
+def stats():
+    return jsonify(model_registry=model_registry.snapshot(), inference={'mode': INFERENCE_MODE, 'backend': INFERENCE_BACKEND, 'io': inference_io_stats}, result_cache=upload_cache_stats)
+
 @app.route('/model')
 def model():
-    photos = Photo.query.filter_by(modul=1).order_by(Photo.id.desc()).all()
+    photos, next_before = gallery_page(1)
     filenames = [os.path.basename(photo.photo) for photo in photos]
-    non_empty_count = db.session.query(func.count(Photo.txt)).filter(Photo.txt.isnot(None), Photo.txt != '').scalar() 
+    non_empty_count = get_counter('labeled_photos', count_labeled_photos)
 
     datasets = Dataset.query.all()
 
-    return render_template('model.html', photos=photos, filenames=filenames, non_empty_count=non_empty_count, datasets=datasets)
+    return render_template('model.html', photos=photos, filenames=filenames, next_before=next_before, non_empty_count=non_empty_count, datasets=datasets)
+
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+def training_data_yaml(model_id):
+    job = TrainingJob.query.filter_by(model_id=model_id).order_by(TrainingJob.id.desc()).first()
+    return os.path.join(job.dataset, 'data.yaml') if job else None
+
+@app.route('/model/<int:model_id>/export', methods=['POST'])
+def export_model(model_id):
+    if db.session.get(Model, model_id) is None:
+        return jsonify({"error": "Модель не найдена."}), 404
+
+    backends = request.form.getlist('backends') or ['onnx', 'openvino']
+    unknown = [backend for backend in backends if not MODEL_BACKENDS.get(backend)]
+    if unknown:
+        return jsonify({"error": f"Неизвестные бэкенды: {unknown}"}), 400
+
+    # калибровка INT8 - на датасете, на котором модель обучалась, если другой не указан
+    selected_dataset = request.form.get('selected_dataset')
+    data = os.path.join(selected_dataset, 'data.yaml') if selected_dataset else training_data_yaml(model_id)
+    if 'openvino_int8' in backends and not (data and os.path.exists(data)):
+        return jsonify({"error": "Для INT8 нужен датасет с data.yaml для калибровки."}), 400
+
+    exports = [ModelExport(model_id=model_id, backend=backend, data=data) for backend in backends]
+    db.session.add_all(exports)
+    db.session.commit()
+    for export in exports:
+        export_executor.submit(run_model_export, export.id)
+
+    return jsonify(exports=[
+        {'id': export.id, 'backend': export.backend, 'status_url': url_for('model_export_status', export_id=export.id)}
+        for export in exports
+    ]), 202
+
+@app.route('/model/exports/<int:export_id>')
+def model_export_status(export_id):
+    export = db.session.get(ModelExport, export_id)
+    if export is None:
+        return jsonify({"error": "Экспорт не найден."}), 404
+
+    return jsonify(
+        id=export.id,
+        model_id=export.model_id,
+        backend=export.backend,
+        status=export.status,
+        path=export.path,
+        error=export.error,
+        created_at=export.created_at.isoformat(),
+        finished_at=export.finished_at.isoformat() if export.finished_at else None,
+    )
+
+def run_model_export(export_id):
+    with app.app_context():
+        export = db.session.get(ModelExport, export_id)
+        export.status = 'running'
+        db.session.commit()
+        try:
+            export.path = export_weights(model_registry.resolve_path(export.model_id), export.backend, export.data)
+            export.status = 'done'
+            print(f"Модель {export.model_id} экспортирована в {export.backend}: {export.path}")
+        except Exception as e:
+            export.status = 'failed'
+            export.error = str(e)
+            print(f"Ошибка экспорта модели {export.model_id} в {export.backend}: {e}")
+        export.finished_at = datetime.now()
+        db.session.commit()
+
+@app.route('/model/<int:model_id>/backend', methods=['POST'])
+def set_model_backend(model_id):
+    entry = db.session.get(Model, model_id)
+    if entry is None:
+        return jsonify({"error": "Модель не найдена."}), 404
+
+    backend = request.form.get('backend') or None
+    if backend is not None and backend not in MODEL_BACKENDS:
+        return jsonify({"error": f"Неизвестный бэкенд: {backend}"}), 400
+
+    entry.backend = backend
+    db.session.commit()
+    active_backend, path = model_registry.resolve_backend(model_id)
+    return jsonify(model_id=model_id, backend=backend, active_backend=active_backend, path=path)
 
 @app.route('/upload_model_files', methods=['POST'])
 def upload_model_files():
@@ -215,70 +1909,95 @@ def upload_model_files():
     
     files = request.files.getlist('files')
     images_dir = os.path.join(os.path.dirname(__file__), "static", "model_images")
-    if not os.path.exists(images_dir):
-        os.makedirs(images_dir)
+    os.makedirs(images_dir, exist_ok=True)
 
-    new_entries = []
     for file in files:
         if file.filename == '':
             return "No selected file", 400
         
         filename = file.filename
-        file_extension = os.path.splitext(filename)[1].lower()
         file_path = os.path.join(images_dir, filename)
         
         try:
-            file.save(file_path)
+            with span('upload_save'), atomic_output(file_path) as tmp_path:
+                file.save(tmp_path)
             print(f"Файл сохранен: {file_path}")
         except Exception as e:
             print(f"Ошибка при сохранении файла {filename}: {e}")
             return "Error saving file", 500
 
-    for file in files:
-        filename = file.filename
-        file_extension = os.path.splitext(filename)[1].lower()
-        relative_image_path = os.path.relpath(os.path.join(images_dir, filename), start=os.path.join(os.path.dirname(__file__), "static"))
-        relative_image_path = relative_image_path.replace("\\", "/")
-        
-        txt_path = None
-        
-        if file_extension == '.txt':
-            image_filename = 'model_images/' + os.path.splitext(filename)[0] + '.jpg'
-            existing_entry = Photo.query.filter_by(photo=image_filename).first()
-            
-            if existing_entry:
-                existing_entry.txt = relative_image_path
-                print(f"Обновлено поле txt для {image_filename}")
-            else:
-                print(f"Запись для {image_filename} не найдена в базе данных.")
-        else:
-            txt_filename = os.path.splitext(filename)[0] + '.txt'
-            txt_file_path = os.path.join(images_dir, txt_filename)
-            
-            if os.path.exists(txt_file_path):
-                txt_path = os.path.relpath(txt_file_path, start=os.path.join(os.path.dirname(__file__), "static"))
-                txt_path = txt_path.replace("\\", "/")
-                print(f"Текстовый файл найден: {txt_path}")
-            else:
-                print(f"Текстовый файл не найден: {txt_file_path}")
-
-            new_entries.append(Photo(photo=relative_image_path, txt=txt_path, photo_date=datetime.now(), modul=1))
-
     try:
-        db.session.bulk_save_objects(new_entries)
-        db.session.commit()
-        print("Записи успешно добавлены в базу данных.")
+        register_model_files([file.filename for file in files])
     except Exception as e:
-        db.session.rollback()
         print(f"Ошибка при сохранении в базу данных: {e}")
         return "Error saving to database", 500
 
     return redirect(url_for('model'))
 
+def register_model_files(filenames):
+    images_dir = os.path.join(os.path.dirname(__file__), "static", "model_images")
+    # один проход: индекс изображение <-> разметка по имени файла без расширения
+    images = {}
+    labels = set()
+    for filename in filenames:
+        stem, file_extension = os.path.splitext(filename)
+        if file_extension.lower() == '.txt':
+            labels.add(stem)
+        else:
+            images[stem] = filename
+
+    # разметка, загруженная раньше изображений, уже лежит в папке: проверяем только имена этого пакета,
+    # при загрузке по частям функция вызывается на каждый файл
+    labels_on_disk = {stem for stem in images.keys() - labels if os.path.exists(os.path.join(images_dir, f'{stem}.txt'))}
+
+    candidates = {f'model_images/{filename}': stem for stem, filename in images.items()}
+    for stem in labels - images.keys():
+        for extension in MODEL_IMAGE_EXTENSIONS:
+            candidates[f'model_images/{stem}{extension}'] = stem
+
+    existing = {}
+    for batch in iter_batches(list(candidates), MODEL_UPLOAD_QUERY_BATCH):
+        for row in db.session.query(Photo.id, Photo.photo, Photo.txt).filter(Photo.modul == 1, Photo.photo.in_(batch)):
+            existing[row.photo] = row
+
+    updates = []
+    new_entries = []
+    labeled_delta = 0
+    now = datetime.now()
+    for photo_path, stem in candidates.items():
+        txt_path = f'model_images/{stem}.txt' if stem in labels or stem in labels_on_disk else None
+        row = existing.get(photo_path)
+        if row is not None:
+            if txt_path and row.txt != txt_path:
+                if not row.txt:
+                    labeled_delta += 1
+                updates.append({'id': row.id, 'txt': txt_path})
+        elif stem in images and photo_path == f'model_images/{images[stem]}':
+            if txt_path:
+                labeled_delta += 1
+            new_entries.append({'photo': photo_path, 'txt': txt_path, 'photo_date': now, 'modul': 1})
+
+    matched_labels = {candidates[photo_path] for photo_path in existing}
+    for stem in sorted(labels - images.keys() - matched_labels):
+        print(f"Запись для изображения {stem} не найдена, разметка сохранена до загрузки изображения.")
+
+    try:
+        with span('db_flush'):
+            db.session.bulk_update_mappings(Photo, updates)
+            db.session.bulk_insert_mappings(Photo, new_entries)
+            bump_counter('labeled_photos', labeled_delta)
+            db.session.commit()
+        schedule_thumbnails(entry['photo'] for entry in new_entries)
+        print(f"Добавлено записей: {len(new_entries)}, обновлено: {len(updates)}.")
+    except Exception:
+        db.session.rollback()
+        raise
+
 @app.route('/copy_photos', methods=['POST'])
 def copy_photos():
     num_photos = request.form.get('num_photos', type=int)
     dataset_name = request.form.get('dataset_name') 
+    base_dataset_id = request.form.get('base_dataset', type=int)
     destination_folder = os.path.join(os.path.dirname(__file__), 'datasets')
     train_size = request.form.get('train_size', type=float)
     val_size = request.form.get('val_size', type=float)
@@ -293,20 +2012,17 @@ def copy_photos():
         return jsonify({"error": "Сумма train_size и val_size должна быть равна 1."}), 400
 
     yolo_folder = os.path.join(destination_folder, dataset_name) 
-    dataset_folder = os.path.join(yolo_folder, 'dataset')
+
+    base_dataset = None
+    if base_dataset_id:
+        base_dataset = db.session.get(Dataset, base_dataset_id)
+        if base_dataset is None or not os.path.isdir(base_dataset.dataset):
+            return jsonify({"error": "Базовый датасет не найден."}), 404
 
     if os.path.exists(yolo_folder):
         return jsonify({"exists": True, "message": "Папка с таким именем уже существует. Продолжить?"}), 409
 
-    try:
-        os.makedirs(yolo_folder, exist_ok=True)
-        os.makedirs(dataset_folder, exist_ok=True)
-        os.makedirs(os.path.join(yolo_folder, 'train'), exist_ok=True)
-        os.makedirs(os.path.join(yolo_folder, 'val'), exist_ok=True)
-    except Exception as e:
-        return jsonify({"error": f"Не удалось создать папку: {str(e)}"}), 500
-
-    photos = Photo.query.filter(Photo.txt.isnot(None), Photo.modul == 1).all()
+    photos = db.session.query(Photo.id, Photo.photo, Photo.txt).filter(Photo.txt.isnot(None), Photo.modul == 1).all()
     print(f"Количество фотографий с текстом в базе данных: {len(photos)}")
     
     if not photos:
@@ -315,45 +2031,29 @@ def copy_photos():
     if num_photos > len(photos):
         return jsonify({"error": "Недостаточно фотографий с текстом в базе данных."}), 400
 
-    selected_photos = random.sample(photos, num_photos)
+    selected_photos = select_dataset_photos(photos, num_photos, base_dataset.dataset if base_dataset else None)
 
     for photo in selected_photos:
-        photo_path = os.path.join('static', photo.photo)
-        print(f"Исходный путь к изображению: {photo_path}")
-        
-        destination_photo_path = os.path.join(dataset_folder, os.path.basename(photo.photo))  # Сохраняем в dataset
-        print(f"Путь к копируемому изображению: {destination_photo_path}")
-        
-        try:
-            if os.path.exists(photo_path):
-                shutil.copy(photo_path, destination_photo_path)
-            else:
-                print(f"Файл изображения не найден: {photo_path}")
-                return jsonify({"error": f"Файл изображения не найден: {photo_path}"}), 404
-        except Exception as e:
-            print(f"Ошибка при копировании файла {photo.photo}: {str(e)}")
-            return jsonify({"error": f"Ошибка при копировании файла {photo.photo}: {str(e)}"}), 500
-
-        if photo.txt:
-            txt_path = os.path.join('static', photo.txt)
-            print(f"Исходный путь к текстовому файлу: {txt_path}")
-            
-            destination_txt_path = os.path.join(dataset_folder, os.path.basename(photo.txt))  # Сохраняем в dataset
-            print(f"Путь к копируемому текстовому файлу: {destination_txt_path}")
-            
-            try:
-                if os.path.exists(txt_path):
-                    shutil.copy(txt_path, destination_txt_path)
-                else:
-                    print(f"Текстовый файл не найден: {txt_path}")
-                    return jsonify({"error": f"Текстовый файл не найден: {txt_path}"}), 404
-            except Exception as e:
-                print(f"Ошибка при копировании текстового файла {photo.txt}: {str(e)}")
-                return jsonify({"error": f"Ошибка при копировании текстового файла {photo.txt}: {str(e)}"}), 500
+        for path in (photo.photo, photo.txt):
+            source_path = os.path.join('static', path)
+            if not os.path.exists(source_path):
+                print(f"Файл не найден: {source_path}")
+                return jsonify({"error": f"Файл не найден: {source_path}"}), 404
+
+    try:
+        os.makedirs(yolo_folder, exist_ok=True)
+        os.makedirs(os.path.join(yolo_folder, 'train'), exist_ok=True)
+        os.makedirs(os.path.join(yolo_folder, 'val'), exist_ok=True)
+    except Exception as e:
+        return jsonify({"error": f"Не удалось создать папку: {str(e)}"}), 500
 
-    split_and_save_dataset(dataset_folder, yolo_folder, test_size=val_size)
+    try:
+        split_and_save_dataset(selected_photos, yolo_folder, test_size=val_size, base_folder=base_dataset.dataset if base_dataset else None)
+    except Exception as e:
+        print(f"Ошибка при экспорте датасета: {str(e)}")
+        return jsonify({"error": f"Ошибка при экспорте датасета: {str(e)}"}), 500
     
-    new_dataset = Dataset(dataset=yolo_folder)
+    new_dataset = Dataset(dataset=yolo_folder, parent_id=base_dataset.id if base_dataset else None)
     try:
         db.session.add(new_dataset)
         db.session.commit()
@@ -363,14 +2063,137 @@ def copy_photos():
 
     return redirect(url_for('model')) 
 
-def split_and_save_dataset(source_folder, destination_folder, test_size):
-    all_files = os.listdir(source_folder)
-    
-    images = [f for f in all_files if f.endswith(('.jpg', '.jpeg', '.png'))]
-    texts = [f for f in all_files if f.endswith('.txt')]
+def link_or_copy(source, destination):
+    # жёсткая ссылка не занимает места; если ФС её не поддерживает или это другой том - копируем
+    try:
+        os.link(source, destination)
+        return 'linked'
+    except FileExistsError:
+        return 'exists'
+    except OSError:
+        shutil.copy2(source, destination)
+        return 'copied'
 
-    images_with_texts = [img for img in images if os.path.splitext(img)[0] + '.txt' in texts]
-    train_files, val_files = train_test_split(images_with_texts, test_size=test_size, random_state=42)
+def label_strata(photos):
+    # страта снимка - самый редкий класс в его разметке, -1 для снимков без объектов, -3 для нечитаемой разметки
+    texts = []
+    unreadable = []
+    for position, photo in enumerate(photos):
+        try:
+            with open(os.path.join('static', photo.txt), 'r', errors='replace') as f:
+                texts.append((position, f.read()))
+        except OSError as e:
+            # отсутствующий файл не мешает выборке; если снимок попадёт в неё, copy_photos вернёт 404
+            print(f"Не удалось прочитать разметку {photo.txt}: {e}")
+            unreadable.append(position)
+    with span('label_parse'):
+        file_index, _, values, reasons = parse_label_texts(texts)
+
+    keys = np.full(len(photos), -1, dtype=np.int64)
+    valid = reasons == 0
+    class_ids = values[valid, 0].astype(np.int64)
+    owners = file_index[valid]
+    if len(class_ids):
+        rarity = np.bincount(class_ids)[class_ids]
+        order = np.lexsort((class_ids, rarity, owners))
+        first_owners, first = np.unique(owners[order], return_index=True)
+        keys[first_owners] = class_ids[order][first]
+    keys[unreadable] = -3
+
+    # страты из одного снимка нельзя разделить, они собираются в общую
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    keys[counts[inverse] < 2] = -2
+    if np.count_nonzero(keys == -2) == 1:
+        values, counts = np.unique(keys, return_counts=True)
+        keys[keys == -2] = values[np.argmax(counts)]
+    return keys
+
+def stratified_split(items, keys, test_size):
+    try:
+        return train_test_split(items, test_size=test_size, stratify=keys, random_state=42)
+    except ValueError as e:
+        print(f"Стратификация невозможна ({e}), обычное разбиение")
+        return train_test_split(items, test_size=test_size, random_state=42)
+
+def scan_dataset_split(folder):
+    if not os.path.isdir(folder):
+        return {}
+    with os.scandir(folder) as entries:
+        return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+
+def same_file(stat, path):
+    try:
+        source = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == source.st_size and stat.st_mtime_ns == source.st_mtime_ns
+
+def select_dataset_photos(photos, num_photos, base_folder=None):
+    # снимки базовой версии остаются в новой, остальное добирается стратифицированной выборкой
+    if num_photos >= len(photos):
+        return list(photos)
+
+    kept = []
+    candidates = list(photos)
+    if base_folder:
+        base_names = set(scan_dataset_split(os.path.join(base_folder, 'train'))) | set(scan_dataset_split(os.path.join(base_folder, 'val')))
+        kept = [photo for photo in photos if os.path.basename(photo.photo) in base_names][:num_photos]
+        kept_ids = {photo.id for photo in kept}
+        candidates = [photo for photo in photos if photo.id not in kept_ids]
+
+    remaining = num_photos - len(kept)
+    if remaining <= 0:
+        return kept
+    if remaining >= len(candidates):
+        return kept + candidates
+
+    # снимки с пропавшими файлами не выбираем, пока хватает целых; иначе copy_photos сообщит о них 404
+    intact = [photo for photo in candidates if all(os.path.exists(os.path.join('static', path)) for path in (photo.photo, photo.txt))]
+    if len(intact) > remaining:
+        candidates = intact
+    elif len(intact) == remaining:
+        return kept + intact
+
+    keys = label_strata(candidates)
+    try:
+        sampled, _ = train_test_split(candidates, train_size=remaining, stratify=keys, random_state=42)
+    except ValueError as e:
+        print(f"Стратификация выборки невозможна ({e}), случайная выборка")
+        sampled = random.sample(candidates, remaining)
+    return kept + sampled
+
+def split_and_save_dataset(photos, destination_folder, test_size, base_folder=None):
+    pairs = {}
+    for photo in photos:
+        image_name = os.path.basename(photo.photo)
+        if image_name not in pairs:
+            pairs[image_name] = photo
+
+    sources = {name: (os.path.join('static', photo.photo), os.path.join('static', photo.txt)) for name, photo in pairs.items()}
+
+    # снимки базовой версии остаются в своей выборке; неизменённые пары берутся прямо из неё
+    previous = {}
+    reused = 0
+    if base_folder:
+        for split in ('train', 'val'):
+            base_split = os.path.join(base_folder, split)
+            base_files = scan_dataset_split(base_split)
+            for image_name, (image_path, txt_path) in list(sources.items()):
+                if image_name not in base_files or image_name in previous:
+                    continue
+                previous[image_name] = split
+                label_name = os.path.splitext(image_name)[0] + '.txt'
+                if label_name in base_files and same_file(base_files[image_name], image_path) and same_file(base_files[label_name], txt_path):
+                    sources[image_name] = (os.path.join(base_split, image_name), os.path.join(base_split, label_name))
+                    reused += 1
+
+    pending = sorted(name for name in pairs if name not in previous)
+    if len(pending) >= 2:
+        train_files, val_files = stratified_split(pending, label_strata([pairs[name] for name in pending]), test_size)
+    else:
+        train_files, val_files = list(pending), []
+    for image_name, split in previous.items():
+        (train_files if split == 'train' else val_files).append(image_name)
 
     train_folder = os.path.join(destination_folder, 'train')
     val_folder = os.path.join(destination_folder, 'val')
@@ -378,20 +2201,201 @@ def split_and_save_dataset(source_folder, destination_folder, test_size):
     os.makedirs(train_folder, exist_ok=True)
     os.makedirs(val_folder, exist_ok=True)
 
-    for file in train_files:
-        shutil.copy(os.path.join(source_folder, file), os.path.join(train_folder, file))
-        txt_file = os.path.splitext(file)[0] + '.txt'
-        if txt_file in texts:
-            shutil.copy(os.path.join(source_folder, txt_file), os.path.join(train_folder, txt_file))
+    tasks = []
+    for folder, names in ((train_folder, train_files), (val_folder, val_files)):
+        for image_name in names:
+            image_path, txt_path = sources[image_name]
+            tasks.append((image_path, os.path.join(folder, image_name)))
+            tasks.append((txt_path, os.path.join(folder, os.path.splitext(image_name)[0] + '.txt')))
 
-    for file in val_files:
-        shutil.copy(os.path.join(source_folder, file), os.path.join(val_folder, file))
-        txt_file = os.path.splitext(file)[0] + '.txt'
-        if txt_file in texts:
-            shutil.copy(os.path.join(source_folder, txt_file), os.path.join(val_folder, txt_file))
+    with span('dataset_link'), ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        outcomes = list(executor.map(lambda task: link_or_copy(*task), tasks))
 
     print(f"Количество файлов в train: {len(train_files)}")
     print(f"Количество файлов в val: {len(val_files)}")
+    print(f"Из базовой версии без изменений: {reused}, изменённых: {len(previous) - reused}, новых: {len(pending)}")
+    print(f"Жёстких ссылок: {outcomes.count('linked')}, копий: {outcomes.count('copied')}")
+    return train_files, val_files
+
+LABEL_INDEX_NAME = '.labels_index.npz'
+LABEL_ERRORS = ('ok', 'format', 'class', 'range', 'size', 'duplicate')
+LABEL_INVALID_LIMIT = int(os.getenv('LABEL_INVALID_LIMIT', 100))
+
+def parse_label_texts(texts):
+    # все строки всех файлов разбираются одним массивом: cls x y w h
+    rows = []
+    for file_id, text in texts:
+        for line_number, line in enumerate(text.splitlines(), 1):
+            tokens = line.split()
+            if tokens:
+                rows.append((file_id, line_number, tokens))
+
+    file_index = np.array([row[0] for row in rows], dtype=np.int32)
+    lines = np.array([row[1] for row in rows], dtype=np.int32)
+    values = np.full((len(rows), 5), np.nan, dtype=np.float32)
+    shaped = [k for k, row in enumerate(rows) if len(row[2]) == 5]
+    if shaped:
+        try:
+            values[shaped] = np.array([token for k in shaped for token in rows[k][2]], dtype=np.float32).reshape(-1, 5)
+        except ValueError:
+            for k in shaped:
+                try:
+                    values[k] = np.array(rows[k][2], dtype=np.float32)
+                except ValueError:
+                    pass
+
+    reasons = np.zeros(len(rows), dtype=np.int8)
+    classes, boxes = values[:, 0], values[:, 1:]
+    checks = (
+        ('format', np.isnan(values).any(axis=1)),
+        ('class', (classes < 0) | (classes != np.floor(classes))),
+        ('range', ((boxes < 0) | (boxes > 1)).any(axis=1)),
+        ('size', (values[:, 3] <= 0) | (values[:, 4] <= 0)),
+    )
+    for reason, mask in checks:
+        reasons[(reasons == 0) & mask] = LABEL_ERRORS.index(reason)
+
+    ok = np.flatnonzero(reasons == 0)
+    if len(ok):
+        keyed = np.column_stack([file_index[ok], values[ok]])
+        _, first = np.unique(keyed, axis=0, return_index=True)
+        duplicates = np.setdiff1d(np.arange(len(ok)), first)
+        reasons[ok[duplicates]] = LABEL_ERRORS.index('duplicate')
+
+    return file_index, lines, values, reasons
+
+def scan_label_files(dataset_folder):
+    files = []
+    mtimes = []
+    pending = [entry.path for entry in os.scandir(dataset_folder) if entry.is_dir()]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.name.endswith('.txt'):
+                    files.append(os.path.relpath(entry.path, dataset_folder).replace("\\", "/"))
+                    mtimes.append(entry.stat().st_mtime_ns)
+    order = np.argsort(files)
+    return np.array(files, dtype=str)[order], np.array(mtimes, dtype=np.int64)[order]
+
+def load_label_index(dataset_folder):
+    # индекс пересобирается только для файлов с изменившимся mtime
+    index_path = os.path.join(dataset_folder, LABEL_INDEX_NAME)
+    files, mtimes = scan_label_files(dataset_folder)
+
+    cached = None
+    if os.path.exists(index_path):
+        try:
+            with np.load(index_path, allow_pickle=False) as data:
+                cached = {key: data[key] for key in data.files}
+        except Exception as e:
+            print(f"Индекс разметки повреждён, пересборка: {e}")
+
+    if cached is not None and np.array_equal(cached['files'], files) and np.array_equal(cached['mtimes'], mtimes):
+        return cached
+
+    remap = np.full(len(cached['files']) if cached else 0, -1, dtype=np.int32)
+    changed = np.ones(len(files), dtype=bool)
+    if cached is not None and len(cached['files']):
+        positions = np.searchsorted(files, cached['files'])
+        positions = np.minimum(positions, max(len(files) - 1, 0))
+        same = (files[positions] == cached['files']) & (mtimes[positions] == cached['mtimes']) if len(files) else np.zeros(len(cached['files']), dtype=bool)
+        remap[same] = positions[same]
+        changed[positions[same]] = False
+
+    keep = remap[cached['file_index']] >= 0 if cached is not None else np.zeros(0, dtype=bool)
+    texts = []
+    for file_id in np.flatnonzero(changed):
+        with open(os.path.join(dataset_folder, files[file_id]), 'r', errors='replace') as f:
+            texts.append((file_id, f.read()))
+    file_index, lines, values, reasons = parse_label_texts(texts)
+
+    if cached is not None:
+        file_index = np.concatenate([remap[cached['file_index'][keep]], file_index])
+        lines = np.concatenate([cached['lines'][keep], lines])
+        values = np.concatenate([cached['values'][keep], values])
+        reasons = np.concatenate([cached['reasons'][keep], reasons])
+
+    order = np.lexsort((lines, file_index))
+    index = {
+        'files': files,
+        'mtimes': mtimes,
+        'file_index': file_index[order],
+        'lines': lines[order],
+        'values': values[order],
+        'reasons': reasons[order],
+    }
+    with atomic_output(index_path) as tmp_path, open(tmp_path, 'wb') as f:
+        np.savez(f, **index)
+    print(f"Индекс разметки обновлён: {len(texts)} из {len(files)} файлов")
+    return index
+
+def label_class_ids(index):
+    valid = index['reasons'] == 0
+    return np.unique(index['values'][valid, 0].astype(np.int64))
+
+def label_stats(index, class_names=None):
+    files, reasons, values = index['files'], index['reasons'], index['values']
+    valid = reasons == 0
+    classes = values[valid, 0].astype(np.int64)
+    widths, heights = values[valid, 3], values[valid, 4]
+    areas = widths * heights
+    histogram = np.bincount(classes) if len(classes) else np.zeros(0, dtype=np.int64)
+    labeled = np.zeros(len(files), dtype=bool)
+    labeled[index['file_index']] = True
+    quantiles = [5, 25, 50, 75, 95]
+
+    def percentiles(array):
+        return dict(zip((f'p{q}' for q in quantiles), np.percentile(array, quantiles).round(4).tolist())) if len(array) else {}
+
+    side_counts, side_edges = np.histogram(np.sqrt(areas), bins=10, range=(0, 1))
+    invalid = np.flatnonzero(~valid)
+    splits = np.array([name.split('/', 1)[0] for name in files], dtype=str)
+    split_names, split_counts = np.unique(splits, return_counts=True)
+    return {
+        'files': len(files),
+        'empty_files': int((~labeled).sum()),
+        'files_per_split': dict(zip(split_names.tolist(), split_counts.tolist())),
+        'boxes': int(valid.sum()),
+        'classes': [
+            {'id': class_id, 'name': class_names[class_id] if class_names and class_id < len(class_names) else None, 'count': int(count)}
+            for class_id, count in enumerate(histogram.tolist()) if count
+        ],
+        'box_size': {
+            'width': percentiles(widths),
+            'height': percentiles(heights),
+            'area': percentiles(areas),
+            'sqrt_area_histogram': {'edges': side_edges.round(2).tolist(), 'counts': side_counts.tolist()},
+        },
+        'invalid_rows': int(len(invalid)),
+        'invalid_by_reason': {LABEL_ERRORS[code]: int(count) for code, count in enumerate(np.bincount(reasons, minlength=len(LABEL_ERRORS))) if code and count},
+        'invalid_samples': [
+            {'file': str(files[index['file_index'][row]]), 'line': int(index['lines'][row]), 'reason': LABEL_ERRORS[reasons[row]]}
+            for row in invalid[:LABEL_INVALID_LIMIT]
+        ],
+    }
+
+def read_class_names(dataset_folder):
+    classes_file_path = os.path.join(dataset_folder, 'classes.txt')
+    if not os.path.exists(classes_file_path):
+        return []
+    with open(classes_file_path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+@app.route('/api/datasets/<int:dataset_id>/labels')
+def dataset_labels(dataset_id):
+    dataset = db.session.get(Dataset, dataset_id)
+    if dataset is None or not os.path.isdir(dataset.dataset):
+        return jsonify({"error": "Датасет не найден."}), 404
+
+    started = time.perf_counter()
+    index = load_label_index(dataset.dataset)
+    indexed = time.perf_counter()
+    stats = label_stats(index, read_class_names(dataset.dataset))
+    stats['index_ms'] = round((indexed - started) * 1000, 2)
+    stats['stats_ms'] = round((time.perf_counter() - indexed) * 1000, 2)
+    return jsonify(stats)
 
 @app.route('/create_class', methods=['POST'])
 def create_class():
@@ -416,13 +2420,22 @@ def create_class():
             print(f"Ошибка при записи в {classes_file_path}: {e}")
 
         try:
-            with open(classes_file_path, 'r') as f:
-                class_names = [line.strip() for line in f.readlines()]
+            class_names = read_class_names(dataset_folder)
             print(f"Имена классов: {class_names}")
         except Exception as e:
             print(f"Ошибка при чтении из {classes_file_path}: {e}")
             class_names = []
 
+        # nc должен покрывать все id классов, встречающиеся в разметке
+        try:
+            class_ids = label_class_ids(load_label_index(dataset_folder))
+        except Exception as e:
+            print(f"Ошибка при разборе разметки датасета: {e}")
+            class_ids = np.zeros(0, dtype=np.int64)
+        if len(class_ids) and class_ids[-1] >= len(class_names):
+            print(f"В разметке есть классы без имени: {[int(i) for i in class_ids if i >= len(class_names)]}")
+            class_names += [f"class_{i}" for i in range(len(class_names), int(class_ids[-1]) + 1)]
+
         num_classes = len(class_names)
 
         try:
@@ -482,7 +2495,6 @@ if __name__ == "__main__":
 
 @app.route('/train', methods=['POST'])
 def train():
-    os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
     try:
         imgsz = int(request.form['imgsz'])
         epochs = int(request.form['epochs'])
@@ -490,51 +2502,305 @@ def train():
         save_period = int(request.form['save_period'])
         selected_dataset = request.form['selected_dataset']
         model_name = request.form['model_name']
+    except (KeyError, ValueError) as e:
+        print(f'Ошибка в параметрах обучения: {e}')
+        return jsonify({"error": f"Некорректные параметры обучения: {e}"}), 400
 
-        if not selected_dataset.endswith(os.path.sep):
-            selected_dataset += os.path.sep
+    path = os.path.normpath(selected_dataset)
+    data_yaml_path = os.path.join(path, 'data.yaml')
 
-        path = os.path.normpath(selected_dataset)
-        data_yaml_path = os.path.join(path, 'data.yaml')
+    if not os.path.exists(data_yaml_path):
+        print(f'Ошибка: файл не найден по пути {data_yaml_path}')
+        return redirect(url_for('model'))
 
-        if not os.path.exists(data_yaml_path):
-            print(f'Ошибка: файл не найден по пути {data_yaml_path}')
-            return redirect(url_for('model'))
-        
-        results_dir = os.path.join(path, 'runs')
-
-        model = YOLO('yolo11n.pt')
-        results = model.train(
-            data=data_yaml_path,
-            imgsz=imgsz,
-            epochs=epochs,
-            batch=batch,
-            save_period=save_period,
-            name=results_dir 
-        )
-        print('Обучение завершено успешно!', 'success')
-
-        model = os.path.join(results_dir, 'weights', 'best.pt')
-        destination_path = os.path.join('static', 'models', f"{model_name}") 
-        destination_path = destination_path.replace("\\", "/")
-        if not os.path.exists(destination_path):
-            os.makedirs(destination_path)
-        shutil.copy(model, destination_path)
+    job = TrainingJob(dataset=path, model_name=model_name, imgsz=imgsz, epochs=epochs, batch=batch, save_period=save_period)
+    db.session.add(job)
+    db.session.commit()
+    job.run_dir = os.path.join(path, 'runs', f"train_{job.id}")
+    db.session.commit()
+    ensure_training_scheduler()
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_id=job.id, status_url=url_for('training_status', job_id=job.id)), 202
+    return redirect(url_for('model', training_job=job.id))
+
+@app.route('/train/<int:job_id>')
+def training_status(job_id):
+    job = db.session.get(TrainingJob, job_id)
+    if job is None:
+        return jsonify({"error": "Задание обучения не найдено."}), 404
+
+    return jsonify(
+        id=job.id,
+        status=job.status,
+        dataset=job.dataset,
+        model_name=job.model_name,
+        epoch=job.epoch,
+        epochs=job.epochs,
+        metrics=json.loads(job.metrics) if job.metrics else {},
+        eta_seconds=job.eta_seconds,
+        model_id=job.model_id,
+        error=job.error,
+        created_at=job.created_at.isoformat(),
+        started_at=job.started_at.isoformat() if job.started_at else None,
+        finished_at=job.finished_at.isoformat() if job.finished_at else None,
+    )
 
-        new_model = Model(model=destination_path)
+@app.route('/train/<int:job_id>/cancel', methods=['POST'])
+def cancel_training(job_id):
+    job = db.session.get(TrainingJob, job_id)
+    if job is None:
+        return jsonify({"error": "Задание обучения не найдено."}), 404
+    if job.status not in ('queued', 'running'):
+        return jsonify({"error": f"Задание уже завершено со статусом {job.status}."}), 409
+
+    process = training_processes.pop(job.id, None)
+    if process is not None:
+        process.terminate()
+        process.join(timeout=30)
+    elif job.pid:
+        # процесс запущен другим воркером сервера
         try:
-            db.session.add(new_model)
+            os.kill(job.pid, signal.SIGTERM)
+        except OSError as e:
+            print(f"Не удалось остановить процесс {job.pid}: {e}")
+    job.status = 'cancelled'
+    job.finished_at = datetime.now()
+    db.session.commit()
+    return jsonify(id=job.id, status=job.status)
+
+@app.route('/train/<int:job_id>/resume', methods=['POST'])
+def resume_training(job_id):
+    job = db.session.get(TrainingJob, job_id)
+    if job is None:
+        return jsonify({"error": "Задание обучения не найдено."}), 404
+    if job.status not in ('cancelled', 'failed'):
+        return jsonify({"error": f"Нельзя продолжить задание со статусом {job.status}."}), 409
+
+    job.resume = os.path.exists(training_checkpoint(job))
+    job.status = 'queued'
+    job.error = None
+    job.finished_at = None
+    db.session.commit()
+    ensure_training_scheduler()
+    return jsonify(id=job.id, status=job.status, resume=job.resume), 202
+
+training_processes = {}
+training_scheduler = []
+training_scheduler_lock = threading.Lock()
+
+def training_checkpoint(job):
+    return os.path.join(job.run_dir, 'weights', 'last.pt')
+
+def training_progress_path(job):
+    return os.path.join(job.run_dir, 'progress.json')
+
+def start_training_scheduler():
+    with training_scheduler_lock:
+        if training_scheduler:
+            return True
+        # процессы обучения ведёт только один воркер, и только он возвращает прерванные задания в очередь
+        if not try_process_lock('training-scheduler'):
+            return False
+
+        with app.app_context():
+            # процессы обучения не переживают перезапуск сервера - продолжаем их с последнего чекпоинта
+            for job in TrainingJob.query.filter_by(status='running').all():
+                job.status = 'queued'
+                job.resume = os.path.exists(training_checkpoint(job))
             db.session.commit()
+
+        scheduler = threading.Thread(target=training_scheduler_loop, name="training-scheduler", daemon=True)
+        scheduler.start()
+        training_scheduler.append(scheduler)
+        return True
+
+def ensure_training_scheduler():
+    # приложение могли импортировать без create_app (flask run): тогда планировщик запускается с первым заданием,
+    # но только если его не держит другой процесс
+    if not training_scheduler:
+        start_training_scheduler()
+
+def training_scheduler_loop():
+    while True:
+        try:
+            with app.app_context():
+                poll_training_jobs()
         except Exception as e:
-            db.session.rollback()
-            return jsonify({"error": f"Не удалось сохранить модель в базе данных: {str(e)}"}), 500
-        
-    except Exception as e:
-        print(f'Ошибка при обучении: {e}', 'error')
-    
-    return redirect(url_for('model'))
+            print(f"Ошибка планировщика обучения: {e}")
+        time.sleep(TRAIN_POLL_INTERVAL)
+
+def poll_training_jobs():
+    for job_id, process in list(training_processes.items()):
+        job = db.session.get(TrainingJob, job_id)
+        sync_training_progress(job)
+        if not process.is_alive():
+            training_processes.pop(job_id)
+            finish_training_job(job, process.exitcode)
+    db.session.commit()
+
+    running = TrainingJob.query.filter_by(status='running').count()
+    while running < TRAIN_MAX_CONCURRENT:
+        job = TrainingJob.query.filter_by(status='queued').order_by(TrainingJob.id).first()
+        if job is None:
+            break
+
+        claimed = db.session.execute(
+            update(TrainingJob)
+            .where(TrainingJob.id == job.id, TrainingJob.status == 'queued')
+            .values(status='running', started_at=datetime.now())
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            continue
+
+        db.session.refresh(job)
+        launch_training_process(job)
+        running += 1
+
+def launch_training_process(job):
+    os.makedirs(job.run_dir, exist_ok=True)
+    params = {
+        'data': os.path.join(job.dataset, 'data.yaml'),
+        'imgsz': job.imgsz,
+        'epochs': job.epochs,
+        'batch': job.batch,
+        'save_period': job.save_period,
+        'name': job.run_dir,
+        'exist_ok': True,
+    }
+    resume_from = training_checkpoint(job) if job.resume else None
+
+    # spawn, чтобы дочерний процесс не наследовал потоки и соединения с БД сервера
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_training_process,
+        args=(params, resume_from, training_progress_path(job)),
+        name=f"training-{job.id}",
+    )
+    process.start()
+    training_processes[job.id] = process
+    job.pid = process.pid
+    db.session.commit()
+    print(f"Запущено обучение {job.id} (pid {process.pid})")
+
+def write_json_atomic(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+def run_training_process(params, resume_from, progress_path):
+    os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+    started = time.time()
+    first_epoch = []
+
+    def on_fit_epoch_end(trainer):
+        epoch = trainer.epoch + 1
+        if not first_epoch:
+            first_epoch.append(trainer.epoch)
+        done = epoch - first_epoch[0]
+        remaining = trainer.epochs - epoch
+        write_json_atomic(progress_path, {
+            'epoch': epoch,
+            'epochs': trainer.epochs,
+            'metrics': {key: float(value) for key, value in trainer.metrics.items()},
+            'eta_seconds': (time.time() - started) / done * remaining if done else None,
+        })
+
+    model = YOLO(resume_from or 'yolo11n.pt')
+    model.add_callback('on_fit_epoch_end', on_fit_epoch_end)
+    if resume_from:
+        model.train(resume=True)
+    else:
+        model.train(**params)
+
+def sync_training_progress(job):
+    progress_path = training_progress_path(job)
+    if not os.path.exists(progress_path):
+        return
+
+    try:
+        with open(progress_path) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    job.epoch = progress['epoch']
+    job.metrics = json.dumps(progress['metrics'])
+    job.eta_seconds = progress['eta_seconds']
+
+def finish_training_job(job, exitcode):
+    job.finished_at = datetime.now()
+    job.pid = None
+    if job.status != 'running':
+        return
+
+    best_model = os.path.join(job.run_dir, 'weights', 'best.pt')
+    if exitcode != 0 or not os.path.exists(best_model):
+        job.status = 'failed'
+        job.error = f"Процесс обучения завершился с кодом {exitcode}"
+        print(f'Ошибка при обучении {job.id}: код {exitcode}')
+        return
+
+    destination_path = os.path.join('static', 'models', f"{job.model_name}") 
+    destination_path = destination_path.replace("\\", "/")
+    os.makedirs(destination_path, exist_ok=True)
+    shutil.copy(best_model, destination_path)
+
+    new_model = Model(model=destination_path)
+    db.session.add(new_model)
+    db.session.flush()
+    job.model_id = new_model.id
+    job.status = 'done'
+    job.eta_seconds = 0
+    print(f'Обучение {job.id} завершено успешно!')
+
+def upgrade_schema():
+    # create_all не меняет существующие таблицы: новые столбцы добавляем сами, повторный запуск ничего не делает
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                print(f"Столбец {table.name}.{column.name} обязателен и не может быть добавлен автоматически")
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            print(f"Добавлен столбец {table.name}.{column.name}")
+
+        # индексы галереи и новых столбцов на уже существующей таблице create_all тоже не создаёт
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+                print(f"Создан индекс {index.name}")
+
+# воркеры WSGI импортируют модуль одновременно - таблицы создаются по очереди
+with file_lock('startup'), app.app_context():
+    db.create_all()
+    upgrade_schema()
+
+def start_background_workers():
+    # перепостановка брошенных заданий тоже по очереди, иначе два воркера создадут по заданию на одни и те же фото
+    with file_lock('startup'):
+        start_inference_workers()
+
+    # новые задания из маршрутов /train подхватит планировщик того воркера, который его держит
+    if not start_training_scheduler():
+        print("Планировщик обучения уже запущен в другом процессе")
+
+def create_app():
+    start_background_workers()
+    return app
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,79 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from ultralytics import YOLO
+
+from app import DEFAULT_MODEL_PATH, MODEL_BACKENDS, backend_path, export_weights, iter_batches
+
+
+def val_images(data):
+    # изображения val из data.yaml датасета, созданного copy_photos
+    dataset_folder = os.path.dirname(os.path.abspath(data))
+    paths = []
+    for extension in ('*.jpg', '*.jpeg', '*.png'):
+        paths += glob.glob(os.path.join(dataset_folder, 'val', extension))
+    return sorted(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость и mAP одних и тех же весов на разных бэкендах инференса")
+    parser.add_argument('--weights', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--data', required=True, help="data.yaml датасета: val для mAP и калибровка INT8")
+    parser.add_argument('--backends', nargs='+', default=list(MODEL_BACKENDS), choices=list(MODEL_BACKENDS))
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=200, help="сколько изображений val прогонять для замера скорости")
+    parser.add_argument('--reexport', action='store_true', help="экспортировать заново, даже если файлы есть")
+    parser.add_argument('--output', help="записать результаты в JSON")
+    args = parser.parse_args()
+
+    images = [cv2.imread(path) for path in val_images(args.data)[:args.limit]]
+    if not images:
+        parser.error(f"В val датасета {args.data} нет изображений")
+    print(f"Изображений для замера: {len(images)}")
+
+    rows = []
+    for backend in args.backends:
+        path = backend_path(args.weights, backend)
+        if backend != 'pytorch' and (args.reexport or not os.path.exists(path)):
+            start = time.perf_counter()
+            path = export_weights(args.weights, backend, args.data)
+            print(f"{backend}: экспорт за {time.perf_counter() - start:.1f} с")
+
+        model = YOLO(path, task='detect')
+        model.predict(images[0], imgsz=args.imgsz, verbose=False)
+        start = time.perf_counter()
+        for batch in iter_batches(images, args.batch):
+            model.predict(batch, imgsz=args.imgsz, verbose=False)
+        elapsed = time.perf_counter() - start
+
+        metrics = model.val(data=args.data, imgsz=args.imgsz, batch=args.batch, device='cpu', plots=False, verbose=False)
+        rows.append({
+            'backend': backend,
+            'path': path,
+            'images_per_second': len(images) / elapsed,
+            'map50': float(metrics.box.map50),
+            'map50_95': float(metrics.box.map),
+        })
+
+    print(f"{'backend':>14} {'img/s':>8} {'mAP50':>7} {'mAP50-95':>9}")
+    for row in rows:
+        print(f"{row['backend']:>14} {row['images_per_second']:>8.1f} {row['map50']:>7.3f} {row['map50_95']:>9.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
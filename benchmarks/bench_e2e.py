@@ -0,0 +1,256 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAMES = {0: 'BadTree', 1: 'Tree'}
+
+
+class StandInDetector:
+    # замена YOLO: детерминированный «детектор» по средней яркости, без весов и без torch-инференса
+    names = NAMES
+
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+
+    def result(self, image, path=''):
+        start = time.perf_counter()
+        brightness = float(image.mean())
+        class_id = 0 if brightness > 100 else 1
+        height, width = image.shape[:2]
+        boxes = torch.tensor([[width * 0.25, height * 0.25, width * 0.75, height * 0.75, min(0.99, brightness / 255), float(class_id)]])
+        result = Results(orig_img=image, path=path, names=NAMES, boxes=boxes)
+        result.speed = {'preprocess': 0.0, 'inference': (time.perf_counter() - start) * 1000, 'postprocess': 0.0}
+        return result
+
+    def predict(self, source, *args, **kwargs):
+        if isinstance(source, np.ndarray):
+            return [self.result(source)]
+        if isinstance(source, list):
+            return [self.result(image) for image in source]
+
+        results = []
+        save_folder = os.path.join(kwargs['project'], kwargs['name']) if kwargs.get('save') else None
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            results.append(self.result(image, path))
+            if save_folder:
+                os.makedirs(save_folder, exist_ok=True)
+                cv2.imwrite(os.path.join(save_folder, name), image)
+        return results
+
+
+def prepare_workspace(mode, frame_interval):
+    # копия приложения во временной папке: static/, datasets/ и база не трогают рабочее дерево
+    workspace = tempfile.mkdtemp(prefix='pinesnap-bench-')
+    shutil.copy(os.path.join(REPO_DIR, 'app.py'), workspace)
+    shutil.copytree(os.path.join(REPO_DIR, 'templates'), os.path.join(workspace, 'templates'))
+    shutil.copytree(os.path.join(REPO_DIR, 'static'), os.path.join(workspace, 'static'),
+                    ignore=shutil.ignore_patterns('base_images', 'images', 'model_images', 'models', '*.pt'))
+    open(os.path.join(workspace, 'static', 'best.pt'), 'wb').close()
+
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workspace, 'bench.db')
+    os.environ['INFERENCE_MODE'] = mode
+    # VIDEO_FRAME_RATE в приложении - интервал между извлекаемыми кадрами в секундах
+    os.environ['VIDEO_FRAME_RATE'] = str(frame_interval)
+    os.environ['THUMBNAIL_CACHE_DIR'] = os.path.join(workspace, 'cache', 'thumbnails')
+    os.chdir(workspace)
+    sys.path.insert(0, workspace)
+
+    import app as pinesnap
+    pinesnap.YOLO = StandInDetector
+    with pinesnap.app.app_context():
+        pinesnap.db.create_all()
+    pinesnap.start_inference_workers()
+    return workspace, pinesnap
+
+
+def synthetic_images(count, rng, size=(480, 640)):
+    images = []
+    for index in range(count):
+        image = rng.integers(0, 255, (*size, 3), dtype=np.uint8)
+        image[:] = np.clip(image.astype(np.int16) // 4 + (index * 37) % 255, 0, 255).astype(np.uint8)
+        images.append(cv2.imencode('.jpg', image)[1].tobytes())
+    return images
+
+
+def synthetic_video(path, frames, rng, size=(360, 480), fps=25):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (size[1], size[0]))
+    for index in range(frames):
+        # сцена меняется каждые полсекунды, чтобы дедупликация кадров оставляла часть из них
+        frame = np.full((*size, 3), (index // (fps // 2) * 53) % 255, dtype=np.uint8)
+        frame += rng.integers(0, 8, frame.shape, dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def scenario(name, count, seconds, **extra):
+    row = {'name': name, 'count': count, 'seconds': round(seconds, 4), 'per_second': round(count / seconds, 2) if seconds else None}
+    row.update(extra)
+    print(f"{name:>28} {count:>7} {seconds:>9.3f} с {row['per_second'] or 0:>10.1f}/с")
+    return row
+
+
+def bench_upload_images(pinesnap, client, count, rng):
+    images = synthetic_images(count, rng)
+    files = [(io.BytesIO(data), f'bench_{index}.jpg') for index, data in enumerate(images)]
+    start = time.perf_counter()
+    response = client.post('/upload', data={'files': files}, headers={'Accept': 'application/json'}, content_type='multipart/form-data')
+    accepted = time.perf_counter()
+    pinesnap.inference_queue.join()
+    finished = time.perf_counter()
+    job = client.get(response.json['status_url']).json
+    return scenario('upload_images', count, finished - start, request_seconds=round(accepted - start, 4), status=job['status'], discovered=job['discovered'])
+
+
+def bench_upload_video(pinesnap, client, frames, rng, workspace):
+    video = synthetic_video(os.path.join(workspace, 'bench.mp4'), frames, rng)
+    start = time.perf_counter()
+    response = client.post('/upload', data={'files': [(io.BytesIO(video), 'bench.mp4')]}, headers={'Accept': 'application/json'}, content_type='multipart/form-data')
+    accepted = time.perf_counter()
+    pinesnap.inference_queue.join()
+    finished = time.perf_counter()
+    job = client.get(response.json['status_url']).json
+    with pinesnap.app.app_context():
+        video_row = pinesnap.Video.query.order_by(pinesnap.Video.id.desc()).first()
+        extracted, skipped = video_row.frame_count, video_row.skipped_frames
+    return scenario('upload_video', frames, finished - start, request_seconds=round(accepted - start, 4), status=job['status'],
+                    extracted_frames=extracted, skipped_frames=skipped, processed=job['processed'])
+
+
+def bench_upload_model_files(client, count, rng):
+    images = synthetic_images(count, rng, size=(160, 160))
+    files = []
+    for index, data in enumerate(images):
+        # разметка идёт раньше изображения - так проверяется и порядок внутри пакета
+        files.append((io.BytesIO(f"{index % 3} 0.5 0.5 0.2 0.2\n".encode()), f'pair_{index}.txt'))
+        files.append((io.BytesIO(data), f'pair_{index}.jpg'))
+    start = time.perf_counter()
+    response = client.post('/upload_model_files', data={'files': files}, content_type='multipart/form-data')
+    return scenario('upload_model_files', count, time.perf_counter() - start, status_code=response.status_code)
+
+
+def bench_copy_photos(pinesnap, client, sizes):
+    rows = []
+    for size in sizes:
+        start = time.perf_counter()
+        response = client.post('/copy_photos', data={'num_photos': size, 'dataset_name': f'bench_{size}', 'train_size': 0.8, 'val_size': 0.2})
+        rows.append(scenario(f'copy_photos[{size}]', size, time.perf_counter() - start, status_code=response.status_code))
+
+    with pinesnap.app.app_context():
+        base = pinesnap.Dataset.query.order_by(pinesnap.Dataset.id.desc()).first()
+    if base is not None:
+        size = sizes[-1]
+        start = time.perf_counter()
+        response = client.post('/copy_photos', data={'num_photos': size, 'dataset_name': f'bench_{size}_delta', 'train_size': 0.8,
+                                                     'val_size': 0.2, 'base_dataset': base.id})
+        rows.append(scenario(f'copy_photos_delta[{size}]', size, time.perf_counter() - start, status_code=response.status_code))
+    return rows
+
+
+def bench_pages(client, repeats):
+    rows = []
+    for name, url in (('page_index', '/'), ('page_model', '/model')):
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            client.get(url)
+            latencies.append(time.perf_counter() - start)
+        rows.append(scenario(name, repeats, sum(latencies), p50_ms=round(statistics.median(latencies) * 1000, 2),
+                             p95_ms=round(np.percentile(latencies, 95) * 1000, 2)))
+
+    for modul in (0, 1):
+        pages = 0
+        items = 0
+        before = None
+        start = time.perf_counter()
+        while True:
+            page = client.get('/api/photos', query_string={'modul': modul, 'before': before} if before else {'modul': modul}).json
+            pages += 1
+            items += len(page['items'])
+            before = page.get('next_before')
+            if not before:
+                break
+        rows.append(scenario(f'gallery_scroll[modul={modul}]', items, time.perf_counter() - start, pages=pages))
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной замер загрузки, инференса и экспорта датасета через маршруты Flask на SQLite")
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--video-frames', type=int, default=250)
+    parser.add_argument('--frame-interval', type=float, default=0.2, help="секунд видео между извлекаемыми кадрами")
+    parser.add_argument('--pairs', type=int, default=1000)
+    parser.add_argument('--dataset-sizes', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--page-repeats', type=int, default=20)
+    parser.add_argument('--mode', choices=['disk', 'memory'], default='memory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_e2e.json')
+    parser.add_argument('--keep', action='store_true', help="не удалять временную копию приложения")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    rng = np.random.default_rng(args.seed)
+    workspace, pinesnap = prepare_workspace(args.mode, args.frame_interval)
+    client = pinesnap.app.test_client()
+    print(f"Рабочая папка: {workspace}, режим инференса: {args.mode}")
+
+    try:
+        results = [
+            bench_upload_images(pinesnap, client, args.images, rng),
+            bench_upload_video(pinesnap, client, args.video_frames, rng, workspace),
+            bench_upload_model_files(client, args.pairs, rng),
+        ]
+        results += bench_copy_photos(pinesnap, client, [size for size in args.dataset_sizes if size <= args.pairs])
+        results += bench_pages(client, args.page_repeats)
+
+        stages = {}
+        for (metric, labels), histogram in pinesnap.histograms.items():
+            if metric == 'pinesnap_stage_seconds':
+                stages[dict(labels)['stage']] = {'count': histogram['count'], 'seconds': round(histogram['sum'], 4)}
+
+        report = {
+            'commit': git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'results': results,
+            'stages': stages,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Результаты записаны в {output}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
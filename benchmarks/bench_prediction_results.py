@@ -0,0 +1,92 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from sqlalchemy import insert
+
+from app import app, db, Photo, apply_prediction_results
+
+
+class SyntheticResult:
+    def __init__(self, path, damaged):
+        self.path = path
+        self.damaged = damaged
+
+
+def seed_photos(count):
+    db.session.query(Photo).delete()
+    now = datetime.now()
+    rows = [{'photo': f'base_images/synthetic_{i}.jpg', 'is_discovered': 0, 'photo_date': now, 'modul': 0} for i in range(count)]
+    db.session.execute(insert(Photo), rows)
+    db.session.commit()
+    return Photo.query.filter(Photo.modul == 0).all()
+
+
+def synthetic_results(photos, damage_ratio, rng):
+    return [SyntheticResult(os.path.join('runs', 'predict', os.path.basename(photo.photo)), rng.random() < damage_ratio) for photo in photos]
+
+
+def run_indexed(photos, results):
+    results_by_path = {result.path: result for result in results}
+    outcomes = {}
+    for photo in photos:
+        result = results_by_path.get(os.path.join('runs', 'predict', os.path.basename(photo.photo)))
+        outcomes[photo.id] = 'images/' + os.path.basename(photo.photo) if result is not None and result.damaged else None
+    return apply_prediction_results(outcomes)
+
+
+def run_legacy(photos, results):
+    # прежний алгоритм: линейный поиск результата и commit на каждую фотографию
+    discovered = 0
+    for photo in photos:
+        damage_detected = False
+        for result in results:
+            if result.path == os.path.join('runs', 'predict', os.path.basename(photo.photo)):
+                damage_detected = result.damaged
+                break
+
+        if damage_detected:
+            discovered += 1
+            photo.is_discovered = 1
+            photo.processed_photo = 'images/' + os.path.basename(photo.photo)
+        else:
+            photo.is_discovered = 0
+            db.session.delete(photo)
+        db.session.commit()
+    return discovered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность записи результатов предсказаний")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--damage-ratio', type=float, default=0.3)
+    parser.add_argument('--legacy-limit', type=int, default=1000, help="максимальный размер, для которого измеряется прежний алгоритм")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        print(f"{'photos':>8} {'variant':>8} {'seconds':>10} {'photos/s':>12}")
+        for size in args.sizes:
+            variants = [('indexed', run_indexed)]
+            if size <= args.legacy_limit:
+                variants.append(('legacy', run_legacy))
+
+            for name, variant in variants:
+                photos = seed_photos(size)
+                results = synthetic_results(photos, args.damage_ratio, rng)
+                start = time.perf_counter()
+                variant(photos, results)
+                elapsed = time.perf_counter() - start
+                print(f"{size:>8} {name:>8} {elapsed:>10.3f} {size / elapsed:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
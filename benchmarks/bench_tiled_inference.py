@@ -0,0 +1,96 @@
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from ultralytics import YOLO
+
+from app import DEFAULT_MODEL_PATH, predict_tiled
+
+
+def load_ground_truth(label_path, width, height):
+    if not os.path.exists(label_path):
+        return np.zeros((0, 5))
+    rows = np.loadtxt(label_path, ndmin=2)
+    if rows.size == 0:
+        return np.zeros((0, 5))
+    cls, xc, yc, w, h = rows[:, 0], rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    return np.stack([cls, xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2], axis=1)
+
+
+def box_iou(a, b):
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def matched(ground_truth, result, iou_threshold):
+    if not len(ground_truth) or result.boxes is None or not len(result.boxes):
+        return 0
+    predicted = result.boxes.xyxy.cpu().numpy()
+    predicted_cls = result.boxes.cls.cpu().numpy()
+    iou = box_iou(ground_truth[:, 1:], predicted)
+    iou[ground_truth[:, 0][:, None] != predicted_cls[None, :]] = 0
+    hits = 0
+    used = set()
+    for row in iou:
+        for index in np.argsort(-row):
+            if row[index] < iou_threshold:
+                break
+            if index not in used:
+                used.add(index)
+                hits += 1
+                break
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Полнота и задержка: инференс по всему кадру против инференса по тайлам")
+    parser.add_argument('--images', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images'))
+    parser.add_argument('--weights', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[640, 1024])
+    parser.add_argument('--overlaps', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    model = YOLO(args.weights)
+    samples = []
+    for image_path in sorted(glob.glob(os.path.join(args.images, '*.jpg'))):
+        image = cv2.imread(image_path)
+        ground_truth = load_ground_truth(os.path.splitext(image_path)[0] + '.txt', image.shape[1], image.shape[0])
+        samples.append((image, ground_truth))
+    total_boxes = sum(len(ground_truth) for _, ground_truth in samples)
+    print(f"Изображений: {len(samples)}, размеченных объектов: {total_boxes}")
+
+    model.predict(samples[0][0], imgsz=args.imgsz, verbose=False)
+    variants = [('full-frame', lambda image: model.predict(image, imgsz=args.imgsz, verbose=False)[0])]
+    for tile_size in args.tile_sizes:
+        for overlap in args.overlaps:
+            variants.append((f"tiled {tile_size}/{overlap:.2f}", lambda image, t=tile_size, o=overlap: predict_tiled(model, image, t, o, args.batch)))
+
+    print(f"{'variant':>18} {'recall':>8} {'ms/image':>10}")
+    for name, predict in variants:
+        hits = 0
+        start = time.perf_counter()
+        for image, ground_truth in samples:
+            hits += matched(ground_truth, predict(image), args.iou)
+        elapsed = time.perf_counter() - start
+        recall = hits / total_boxes if total_boxes else 0.0
+        print(f"{name:>18} {recall:>8.3f} {elapsed / len(samples) * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
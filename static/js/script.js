@@ -47,6 +47,87 @@ function zoomImage(src, shelfId) {
     zoomedImage.style.display = 'flex';
 }
 
+function fetchPhotoPage(url, before) {
+    const separator = url.includes('?') ? '&' : '?';
+    return fetch(`${url}${separator}before=${before}`).then(response => response.json());
+}
+
+function initInfiniteScroll(container, sentinel, url, nextBefore, renderItem) {
+    if (!container || !sentinel || !nextBefore) {
+        return;
+    }
+
+    let loading = false;
+    const observer = new IntersectionObserver(function(entries) {
+        if (!entries[0].isIntersecting || loading || !nextBefore) {
+            return;
+        }
+
+        loading = true;
+        fetchPhotoPage(url, nextBefore)
+            .then(data => {
+                data.items.forEach(item => container.appendChild(renderItem(item)));
+                nextBefore = data.next_before;
+                if (!nextBefore) {
+                    observer.disconnect();
+                }
+            })
+            .catch(error => console.error('Ошибка:', error))
+            .finally(() => { loading = false; });
+    }, { rootMargin: '400px' });
+    observer.observe(sentinel);
+}
+
+function initScrollPaging(select, url, nextBefore, renderItem) {
+    if (!select || !nextBefore) {
+        return;
+    }
+
+    let loading = false;
+    select.addEventListener('scroll', function() {
+        if (loading || !nextBefore || select.scrollTop + select.clientHeight < select.scrollHeight - 40) {
+            return;
+        }
+
+        loading = true;
+        fetchPhotoPage(url, nextBefore)
+            .then(data => {
+                data.items.forEach(item => select.appendChild(renderItem(item)));
+                nextBefore = data.next_before;
+                filterFiles();
+            })
+            .catch(error => console.error('Ошибка:', error))
+            .finally(() => { loading = false; });
+    });
+}
+
+function renderGalleryPhoto(item) {
+    const wrapper = document.createElement('div');
+    const img = document.createElement('img');
+    img.src = item.thumbnail_url;
+    img.dataset.full = item.url;
+    img.alt = 'Processed Image';
+    img.className = 'thumbnail';
+    img.loading = 'lazy';
+    img.addEventListener('click', function() { zoomImage(this.dataset.full, String(item.id)); });
+
+    const title = document.createElement('h3');
+    title.className = 'name';
+    title.textContent = item.date;
+
+    wrapper.appendChild(img);
+    wrapper.appendChild(title);
+    return wrapper;
+}
+
+function renderModelOption(item) {
+    const option = document.createElement('option');
+    option.value = item.photo;
+    option.dataset.txt = item.txt === null ? 'None' : item.txt;
+    option.textContent = item.filename;
+    return option;
+}
+
 function closeZoom() {
     const zoomedImage = document.getElementById('zoom-image');
     zoomedImage.style.display = 'none';
@@ -58,7 +139,7 @@ function updateImage() {
     let selectedFilePath = select.value;
     document.getElementById("selectedFileName").innerText = selectedFileName;
     let img = document.getElementById("fileImage");
-    img.src = '/static/' + selectedFilePath;
+    img.src = '/thumbnails/medium/' + selectedFilePath;
 }
 
 function filterFiles() {
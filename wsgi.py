@@ -0,0 +1,7 @@
+# Точка входа для запуска под WSGI-сервером в несколько процессов, например:
+#   gunicorn -w 4 --threads 4 wsgi:app
+#   waitress-serve --threads 8 wsgi:app
+# Без --preload: потоки инференса и планировщик обучения должны стартовать в каждом воркере после fork.
+from app import create_app
+
+app = create_app()